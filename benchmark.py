@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os, os.path
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import synthlog
+
+#
+# Benchmarks of the analysis stages on a synthetic log tree. Every stage is
+# timed over a few repetitions and profiled once more for its peak Python
+# heap (tracemalloc, worker processes are not included). The results are
+# written as JSON tagged with the commit, so that two runs at the same scale
+# and seed can be compared with --compare.
+
+def stage_report(ctx):
+    # Parse every section of a single chip at a time
+    import report
+    names=ctx['names'][:ctx['single']]
+    for name in names:
+        r=report.Report(name,'log')
+        r.preload()
+    return len(names)
+
+def stage_reports(ctx):
+    import report
+    reports=report.Reports.from_directory('log',jobs=ctx['jobs'])
+    for section in reports.SECTIONS:
+        getattr(reports,section)
+    ctx['reports']=reports
+    return len(reports.calib)+len(reports.icalib)+len(reports.noise)+len(reports.error)
+
+def stage_calib(ctx):
+    import calibtools
+    ctx['calib']=calibtools.calibrate(ctx['reports'].calib)
+    return len(ctx['calib'])
+
+def stage_icalib(ctx):
+    import icalibtools
+    icalib=icalibtools.calibrate(ctx['reports'].icalib,fixCalib=True)
+    return len(icalib)
+
+def stage_pbreport(ctx):
+    # Includes the voltage calibration of each board's AMAC, from an empty
+    # cache under the synthetic log root
+    import pbreport, calibcache
+    cachedir=os.path.join(ctx['root'],'data','calib')
+    shutil.rmtree(cachedir,ignore_errors=True)
+    cache=calibcache.CalibCache(cachedir,os.path.join(ctx['root'],'log'))
+    for name in ctx['names']:
+        pbreport.Report('PB_%s'%name,os.path.join(ctx['root'],'pblog'),cache=cache)
+    return len(ctx['names'])
+
+# Stages in order, as (name, function). Later stages use the results of
+# earlier ones.
+STAGES=[('report.Report'            ,stage_report  ),
+        ('report.Reports'           ,stage_reports ),
+        ('calibtools.calibrate'     ,stage_calib   ),
+        ('icalibtools.calibrate'    ,stage_icalib  ),
+        ('pbreport.Report'          ,stage_pbreport)]
+
+def commit():
+    # Short hash of HEAD, with a + if the tree has local changes
+    here=os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev=subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=here,text=True).strip()
+        dirty=subprocess.check_output(['git','status','--porcelain','--untracked-files=no'],cwd=here,text=True).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+    return rev+('+' if dirty else '')
+
+def run(stages,ctx,repeat=3,memory=True):
+    results={}
+    for name,stage in stages:
+        times=[]
+        for i in range(repeat):
+            start=time.perf_counter()
+            rows=stage(ctx)
+            times.append(time.perf_counter()-start)
+
+        result={'time':min(times),'times':times,'rows':rows}
+        if memory:
+            tracemalloc.start()
+            stage(ctx)
+            result['peak_mb']=tracemalloc.get_traced_memory()[1]/1e6
+            tracemalloc.stop()
+
+        print('%-24s %8.3f s %10s MB %10d rows'%(name,result['time'],'%.1f'%result['peak_mb'] if memory else '-',rows))
+        results[name]=result
+    return results
+
+def compare(results,previous,threshold=0.1):
+    # Print the time ratio of each stage to a previous result
+    if (results['chips'],results['seed'])!=(previous['chips'],previous['seed']):
+        print('WARNING: Comparing runs with different chips/seed')
+
+    print('%-24s %10s %10s %8s'%('stage',previous['commit'],results['commit'],'ratio'))
+    for name,result in results['stages'].items():
+        if name not in previous['stages']: continue
+        old=previous['stages'][name]['time']
+        ratio=result['time']/old
+        flag=' SLOWER' if ratio>1+threshold else (' faster' if ratio<1-threshold else '')
+        print('%-24s %9.3fs %9.3fs %8.2f%s'%(name,old,result['time'],ratio,flag))
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Benchmark the analysis stages on synthetic logs.')
+    parser.add_argument('--chips'  ,type=int,default=80                   ,help='Number of synthetic chips')
+    parser.add_argument('--seed'   ,type=int,default=0                    ,help='Seed of the synthetic logs')
+    parser.add_argument('--root'   ,default='data/benchmark/synth'        ,help='Where to write the synthetic logs')
+    parser.add_argument('--jobs'   ,type=int,default=os.cpu_count()       ,help='Worker processes for the parallel stages')
+    parser.add_argument('--repeat' ,type=int,default=3                    ,help='Timing repetitions of each stage')
+    parser.add_argument('--single' ,type=int,default=10                   ,help='Chips loaded one at a time by report.Report')
+    parser.add_argument('--stages' ,nargs='+',default=None                ,help='Only run these stages (and the ones they need)')
+    parser.add_argument('--no-memory',action='store_true'                 ,help='Skip the tracemalloc pass')
+    parser.add_argument('--output' ,default=None                          ,help='Result file, default data/benchmark/<commit>_<chips>.json')
+    parser.add_argument('--compare',default=None                          ,help='Previous result file to compare to')
+    args=parser.parse_args()
+
+    warnings.simplefilter('ignore')
+
+    results={'commit':commit(),'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+             'chips':args.chips,'seed':args.seed,'jobs':args.jobs,'repeat':args.repeat,
+             'python':platform.python_version(),'numpy':np.__version__,'pandas':pd.__version__,
+             'machine':platform.machine(),'cpus':os.cpu_count()}
+    output=args.output or os.path.join('data/benchmark','%s_%d.json'%(results['commit'],args.chips))
+    output=os.path.abspath(output)
+    previous=None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous=json.load(fh)
+
+    #
+    # Synthetic logs, regenerated if the scale or seed changed
+    root=os.path.abspath(args.root)
+    stamp=os.path.join(root,'synthlog.json')
+    config={'chips':args.chips,'seed':args.seed}
+    if not os.path.exists(stamp) or json.load(open(stamp))!=config:
+        shutil.rmtree(root,ignore_errors=True)
+        start=time.perf_counter()
+        synthlog.generate(root,args.chips,args.seed)
+        with open(stamp,'w') as fh:
+            json.dump(config,fh)
+        print('Generated %d chips in %.1f s'%(args.chips,time.perf_counter()-start))
+
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(root)
+
+    #
+    # Run
+    stages=STAGES
+    if args.stages:
+        last=max([[name for name,stage in STAGES].index(name) for name in args.stages])
+        stages=[(name,stage) for name,stage in STAGES[:last+1] if name in args.stages or name=='report.Reports']
+
+    ctx={'names':synthlog.chipnames(args.chips),'jobs':args.jobs,'single':args.single,'root':root}
+    results['stages']=run(stages,ctx,args.repeat,not args.no_memory)
+
+    os.makedirs(os.path.dirname(output),exist_ok=True)
+    with open(output,'w') as fh:
+        json.dump(results,fh,indent=1)
+    print('Results in %s'%output)
+
+    if previous!=None:
+        compare(results,previous)
@@ -0,0 +1,130 @@
+import pandas as pd
+
+import glob
+import hashlib
+import json
+import os, os.path
+
+import report
+import calibtools
+import icalibtools
+
+# Input log family of each calibration
+INPUTS={'calib' :'calib_ADC_V',
+        'icalib':'calib_ADC_I'}
+
+def filehash(path):
+    h=hashlib.sha1()
+    with open(path,'rb') as fh:
+        for chunk in iter(lambda: fh.read(1<<20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint(paths,previous=None):
+    # Describe a set of input files by name, size, mtime and content hash.
+    # Hashes are reused from a previous fingerprint when the size and mtime of
+    # a file are unchanged, so that a valid cache never reads the logs.
+    previous={entry['path']:entry for entry in (previous or [])}
+
+    entries=[]
+    for path in sorted(paths):
+        st=os.stat(path)
+        entry={'path':os.path.basename(path),'size':st.st_size,'mtime':st.st_mtime_ns}
+        old=previous.get(entry['path'])
+        if old!=None and old['size']==entry['size'] and old['mtime']==entry['mtime']:
+            entry['sha1']=old['sha1']
+        else:
+            entry['sha1']=filehash(path)
+        entries.append(entry)
+    return entries
+
+def samefiles(a,b):
+    # Same content, mtime does not matter (ie: after a fresh checkout)
+    return [(e['path'],e['size'],e['sha1']) for e in a]==[(e['path'],e['size'],e['sha1']) for e in b]
+
+def refit(AMAC,kind='calib'):
+    r=report.Report(AMAC)
+    if kind=='calib':
+        return calibtools.calibrate(r.calib)
+    else:
+        icalib=icalibtools.calibrate(r.icalib,fixCalib=True)
+        return icalib[icalib.status=='ok'].drop(columns='status')
+
+class CalibCache:
+    # Calibration results stored as <kind>_<AMAC>.csv in cachedir, next to a
+    # <kind>_<AMAC>.json manifest with the fingerprint of the input logs.
+    # The inputs are found from a report.index_logs() index if one is given.
+    def __init__(self,cachedir='data/calib',logdir='log',index=None):
+        self.cachedir=cachedir
+        self.logdir=logdir
+        self.index=index
+
+    def inputs(self,AMAC,kind='calib'):
+        family=INPUTS[kind]
+        if self.index!=None:
+            return [path for name,channel,path in self.index.get(AMAC,{}).get(family,[])]
+        return glob.glob(os.path.join(self.logdir,report.FAMILIES[family][0].format(AMAC=AMAC)))
+
+    def csvpath(self,AMAC,kind='calib'):
+        return os.path.join(self.cachedir,'%s_%s.csv'%(kind,AMAC))
+
+    def manifestpath(self,AMAC,kind='calib'):
+        return os.path.join(self.cachedir,'%s_%s.json'%(kind,AMAC))
+
+    def manifest(self,AMAC,kind='calib'):
+        path=self.manifestpath(AMAC,kind)
+        if not os.path.exists(path): return None
+        with open(path) as fh:
+            return json.load(fh)
+
+    def isvalid(self,AMAC,kind='calib'):
+        # Returns the current fingerprint if the cached calibration is up to
+        # date. A calibration without a manifest (ie: the tracked CSV files of
+        # a fresh checkout) is taken to be up to date, and only its manifest
+        # is written.
+        if not os.path.exists(self.csvpath(AMAC,kind)):
+            return None
+        manifest=self.manifest(AMAC,kind)
+        if manifest==None:
+            inputs=fingerprint(self.inputs(AMAC,kind))
+            self._writemanifest(AMAC,kind,inputs)
+            return inputs
+
+        inputs=fingerprint(self.inputs(AMAC,kind),manifest['inputs'])
+        if not samefiles(inputs,manifest['inputs']):
+            return None
+
+        if inputs!=manifest['inputs']:
+            self._writemanifest(AMAC,kind,inputs)
+        return inputs
+
+    def load(self,AMAC,kind='calib'):
+        # Cached calibration, None if missing or out of date
+        if self.isvalid(AMAC,kind)==None:
+            return None
+        return pd.read_csv(self.csvpath(AMAC,kind),float_precision='round_trip')
+
+    def store(self,AMAC,calib,kind='calib',inputs=None):
+        if inputs==None:
+            inputs=fingerprint(self.inputs(AMAC,kind))
+
+        os.makedirs(self.cachedir,exist_ok=True)
+        path=self.csvpath(AMAC,kind)
+        calib.to_csv(path+'.tmp', index=False)
+        os.replace(path+'.tmp',path)
+        self._writemanifest(AMAC,kind,inputs)
+
+    def get(self,AMAC,kind='calib',fit=refit):
+        # Cached calibration, refitting only on a miss or when an input changed
+        calib=self.load(AMAC,kind)
+        if calib is None:
+            inputs=fingerprint(self.inputs(AMAC,kind))
+            calib=fit(AMAC,kind)
+            self.store(AMAC,calib,kind,inputs)
+        return calib
+
+    def _writemanifest(self,AMAC,kind,inputs):
+        path=self.manifestpath(AMAC,kind)
+        with open(path+'.tmp','w') as fh:
+            json.dump({'AMAC':AMAC,'kind':kind,'inputs':inputs},fh,indent=1)
+        os.replace(path+'.tmp',path)
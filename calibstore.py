@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+
+import argparse
+import glob
+import json
+import os, os.path
+
+#
+# Fleet-wide calibrations in a single binary file that is memory-mapped by
+# its readers, so that looking up coefficients needs no parsing and the pages
+# are shared by all processes reading it. The file is a JSON header with the
+# AMAC and channel names, followed by the calibrations as a fixed-layout
+# structured array in the row order of the CSV files, the sorted keys and the
+# row of each sorted key. Unused columns (OpAmpGain, Voff and RI of the
+# voltage calibration) are 0 and NaN.
+
+MAGIC=b'AMACCAL1'
+ALIGN=64
+
+DTYPE=np.dtype([('AMAC'          ,'<u2'),
+                ('Channel'       ,'u1' ),
+                ('BandgapControl','u1' ),
+                ('RampGain'      ,'u1' ),
+                ('OpAmpGain'     ,'u1' ),
+                ('m'             ,'<f8'),
+                ('b'             ,'<f8'),
+                ('Voff'          ,'<f8'),
+                ('RI'            ,'<f8')],align=True)
+
+# CSV columns of each calibration kind, see calibcache.CalibCache
+COLUMNS={'calib' :['AMAC','Channel','BandgapControl','RampGain','m','b'],
+         'icalib':['AMAC','Channel','BandgapControl','RampGain','OpAmpGain','m','b','Voff','RI']}
+
+def _key(AMAC,Channel,BG,RG,OA):
+    # Sort key packing the record keys into 48 bits
+    key=np.asarray(AMAC,dtype=np.uint64)
+    for field in [Channel,BG,RG,OA]:
+        key=(key<<np.uint64(8))|np.asarray(field,dtype=np.uint64)
+    return key
+
+def _align(n):
+    return (n+ALIGN-1)//ALIGN*ALIGN
+
+def write(path,calib,kind='calib'):
+    # Write a calibration table (ie: the concatenated CSV files) as a store
+    amacs   =sorted(calib.AMAC   .astype(str).unique())
+    channels=sorted(calib.Channel.astype(str).unique())
+    if len(amacs)>=1<<16 or len(channels)>=1<<8:
+        raise ValueError('Too many AMACs or channels for the store layout')
+
+    records=np.zeros(len(calib),dtype=DTYPE)
+    records['AMAC'   ]=pd.Categorical(calib.AMAC   .astype(str),categories=amacs   ).codes
+    records['Channel']=pd.Categorical(calib.Channel.astype(str),categories=channels).codes
+    for column in DTYPE.names[2:]:
+        if column in calib.columns:
+            records[column]=calib[column].values
+        elif DTYPE[column].kind=='f':
+            records[column]=np.nan
+
+    keys=_key(records['AMAC'],records['Channel'],records['BandgapControl'],records['RampGain'],records['OpAmpGain'])
+    order=np.argsort(keys,kind='stable').astype('<u4')
+
+    header=json.dumps({'kind':kind,'columns':COLUMNS[kind],'amacs':amacs,'channels':channels,'count':len(records)}).encode()
+    offset=_align(len(MAGIC)+8+len(header))
+
+    with open(path+'.tmp','wb') as fh:
+        fh.write(MAGIC)
+        fh.write(np.uint64(len(header)).tobytes())
+        fh.write(header.ljust(offset-len(MAGIC)-8))
+        fh.write(records.tobytes())
+        fh.write(b'\0'*(_align(records.nbytes)-records.nbytes))
+        fh.write(keys[order].astype('<u8').tobytes())
+        fh.write(order.tobytes())
+    os.replace(path+'.tmp',path)
+
+class CalibStore:
+    # Read-only, memory-mapped calibration store written by write()
+    def __init__(self,path):
+        self.path=path
+        with open(path,'rb') as fh:
+            if fh.read(len(MAGIC))!=MAGIC:
+                raise ValueError('%s is not a calibration store'%path)
+            size=int(np.frombuffer(fh.read(8),dtype='<u8')[0])
+            header=json.loads(fh.read(size))
+
+        self.kind    =header['kind']
+        self.columns =header['columns']
+        self.amacs   =header['amacs']
+        self.channels=header['channels']
+        self._amacid   ={name:i for i,name in enumerate(self.amacs   )}
+        self._channelid={name:i for i,name in enumerate(self.channels)}
+
+        count=header['count']
+        if count==0:
+            # Nothing to map
+            self.records=np.zeros(0,dtype=DTYPE)
+            self.keys   =np.zeros(0,dtype='<u8')
+            self.order  =np.zeros(0,dtype='<u4')
+            return
+
+        offset=_align(len(MAGIC)+8+size)
+        self.records=np.memmap(path,dtype=DTYPE,mode='r',offset=offset,shape=(count,))
+        offset+=_align(DTYPE.itemsize*count)
+        self.keys   =np.memmap(path,dtype='<u8',mode='r',offset=offset,shape=(count,))
+        self.order  =np.memmap(path,dtype='<u4',mode='r',offset=offset+8*count,shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self,AMAC,Channel,BG=10,RG=3,OA=0):
+        # Row of the calibration of each key, arguments can be arrays
+        if self.kind=='calib': OA=0
+        AMAC,Channel,BG,RG,OA=np.broadcast_arrays(AMAC,Channel,BG,RG,OA)
+        amacid   =np.array([self._amacid   .get(name,-1) for name in AMAC   .flat],dtype=int).reshape(AMAC.shape)
+        channelid=np.array([self._channelid.get(name,-1) for name in Channel.flat],dtype=int).reshape(AMAC.shape)
+
+        if len(self.keys)==0 and AMAC.size>0:
+            raise KeyError('No calibrations in %s'%self.path)
+
+        valid=(amacid>=0)&(channelid>=0)
+        key=_key(np.where(valid,amacid,0),np.where(valid,channelid,0),BG,RG,OA)
+        pos=np.minimum(np.searchsorted(self.keys,key),max(len(self.keys)-1,0))
+        found=valid&(self.keys[pos]==key) if len(self.keys)>0 else valid
+        if not found.all():
+            i=np.flatnonzero(~found)[0]
+            raise KeyError('No calibration for AMAC=%s, Channel=%s, BG=%s, RG=%s, OA=%s'%(AMAC.flat[i],Channel.flat[i],BG.flat[i],RG.flat[i],OA.flat[i]))
+        return self.order[pos]
+
+    def coefficients(self,AMAC,Channel,BG=10,RG=3,OA=0):
+        idx=self.lookup(AMAC,Channel,BG,RG,OA)
+        return self.records['m'][idx],self.records['b'][idx]
+
+    def convert(self,count,AMAC,Channel,BG=10,RG=3,OA=0):
+        m,b=self.coefficients(AMAC,Channel,BG,RG,OA)
+        return m*count+b
+
+    def to_frame(self,AMAC=None):
+        # Calibration table with the columns of the CSV files, of one AMAC
+        # or of all of them
+        records=self.records
+        if AMAC!=None:
+            records=records[records['AMAC']==self._amacid[AMAC]]
+
+        data=pd.DataFrame({column:records[column] for column in self.columns if column not in ('AMAC','Channel')})
+        data.insert(0,'AMAC'   ,np.array(self.amacs   ,dtype=object)[records['AMAC'   ]])
+        data.insert(1,'Channel',np.array(self.channels,dtype=object)[records['Channel']])
+        for column in ['BandgapControl','RampGain','OpAmpGain']:
+            if column in data.columns: data[column]=data[column].astype(int)
+        return data
+
+def build(cachedir='data/calib',kind='calib',path=None):
+    # Store of all <kind>_<AMAC>.csv calibrations in cachedir, by default
+    # written to <cachedir>/<kind>.bin
+    paths=sorted(glob.glob(os.path.join(cachedir,'%s_*.csv'%kind)))
+    if len(paths)==0:
+        raise ValueError('No %s calibrations in %s'%(kind,cachedir))
+    calib=pd.concat([pd.read_csv(csvpath,float_precision='round_trip') for csvpath in paths],ignore_index=True)
+    path=path or os.path.join(cachedir,'%s.bin'%kind)
+    write(path,calib,kind)
+    return path
+
+def export(store,cachedir):
+    # Write the store back as one <kind>_<AMAC>.csv per AMAC
+    os.makedirs(cachedir,exist_ok=True)
+    for AMAC in store.amacs:
+        store.to_frame(AMAC).to_csv(os.path.join(cachedir,'%s_%s.csv'%(store.kind,AMAC)),index=False)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Build the binary calibration stores from the calibration CSV files.')
+    parser.add_argument('--calibrations',nargs='+',choices=list(COLUMNS),default=list(COLUMNS),help='Calibrations to store')
+    parser.add_argument('--input'       ,default='data/calib'                                 ,help='Calibration CSV directory')
+    parser.add_argument('--export'      ,default=None                                         ,help='Write the stores back as CSV files to this directory')
+    args=parser.parse_args()
+
+    for kind in args.calibrations:
+        path=build(args.input,kind)
+        store=CalibStore(path)
+        print('%s: %d calibrations of %d AMACs in %s'%(kind,len(store),len(store.amacs),path))
+        if args.export:
+            export(store,args.export)
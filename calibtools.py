@@ -1,40 +1,174 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 import glob, re
 
+CALIBKEYS=['AMAC','Channel','BandgapControl','RampGain']
+
+# Codes of the 10-bit ADC
+NCODES=1024
+
+def linfit(data,keys,x,y):
+    # Least-squares fit of y = m*x + b for every group of keys, computed in one
+    # pass from centered grouped sums. Returns a frame indexed by keys.
+    data=data.dropna(subset=keys)
+    g=data.groupby(keys,sort=True,observed=True)
+    gid=g.ngroup().values
+    size=g.size()
+
+    xv=data[x].values.astype(float)
+    yv=data[y].values.astype(float)
+    n   =np.bincount(gid,minlength=len(size))
+    xbar=np.bincount(gid,xv,minlength=len(size))/n
+    ybar=np.bincount(gid,yv,minlength=len(size))/n
+    dx=xv-xbar[gid]
+    dy=yv-ybar[gid]
+    sxx=np.bincount(gid,dx*dx,minlength=len(size))
+    sxy=np.bincount(gid,dx*dy,minlength=len(size))
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        m=sxy/sxx
+    b=ybar-m*xbar
+
+    return pd.DataFrame({'n':n,'m':m,'b':b},index=size.index)
+
 def calibrate(data):
-    calibs=pd.DataFrame(columns=['AMAC','Channel','BandgapControl','RampGain','m','b'])
+    data=data[CALIBKEYS+['InputVoltage','ADCvalue']].dropna(subset=CALIBKEYS)
 
-    for amackey,amacgroup in data.groupby('AMAC'):
-        for chkey,chgroup in amacgroup.groupby('Channel'):
-            for bgkey,bggroup in chgroup.groupby('BandgapControl'):
-                for rgkey,rggroup in bggroup.groupby('RampGain'):
-                    # Determine fit range
-                    xmax=0.6 if rgkey==1 else 1.
-                    fitdata=rggroup[rggroup.InputVoltage<xmax]
-                    m,b=np.polyfit(pd.to_numeric(fitdata.ADCvalue),fitdata.InputVoltage,1)
-
-                    # Filter out bad guys
-                    filtfitdata=fitdata[abs(fitdata.ADCvalue-(fitdata.InputVoltage-b)/m)<16]
-                    if len(filtfitdata)==0:
-                        print('WARNING: No data after filter for AMAC=%s, Channel=%s, BandgapControl=%d, RampGain=%d.'%(amackey,chkey,bgkey,rgkey))
-                        continue
-                    m,b=np.polyfit(pd.to_numeric(filtfitdata.ADCvalue),filtfitdata.InputVoltage,1)
-
-                    # Save the results
-                    calibs=calibs.append({'AMAC':amackey,
-                                          'Channel':chkey,
-                                          'BandgapControl':bgkey,
-                                          'RampGain':rgkey,
-                                          'm':m,
-                                          'b':b},
-                                         ignore_index=True)
-
-    return calibs
+    # Determine fit range
+    xmax=np.where(data.RampGain.values==1,0.6,1.)
+    fitdata=data[data.InputVoltage.values<xmax]
+    fits=linfit(fitdata,CALIBKEYS,'ADCvalue','InputVoltage')
+
+    # Filter out bad guys
+    gid=fitdata.groupby(CALIBKEYS,sort=True,observed=True).ngroup().values
+    m=fits.m.values[gid]
+    b=fits.b.values[gid]
+    filtfitdata=fitdata[abs(fitdata.ADCvalue.values-(fitdata.InputVoltage.values-b)/m)<16]
+    calibs=linfit(filtfitdata,CALIBKEYS,'ADCvalue','InputVoltage')
+
+    for key in fits.index.difference(calibs.index):
+        print('WARNING: No data after filter for AMAC=%s, Channel=%s, BandgapControl=%d, RampGain=%d.'%key)
+
+    # Save the results
+    return calibs[['m','b']].reset_index()
+
+class CalibrationTable:
+    # Calibration table indexed by its keys for constant time lookups of the
+    # fit coefficients. Maps the convert() arguments to the table columns.
+    ARGKEYS={'AMAC'   :'AMAC',
+             'Channel':'Channel',
+             'BG'     :'BandgapControl',
+             'RG'     :'RampGain'}
+
+    def __init__(self,calib):
+        if 'status' in calib: calib=calib[calib.status=='ok']
+        self.calib=calib.reset_index(drop=True)
+
+        self.m=self.calib.m.values.astype(float)
+        self.b=self.calib.b.values.astype(float)
+
+        # First entry wins, same as filtering the table and taking iloc[0]
+        self.keys=list(zip(*[self.calib[col].tolist() for col in self.ARGKEYS.values()]))
+        self.index={}
+        for idx,key in enumerate(self.keys):
+            self.index.setdefault(key,idx)
+
+    def __len__(self):
+        return len(self.calib)
+
+    def lookup(self,**kwargs):
+        key=tuple(kwargs.get(arg) for arg in self.ARGKEYS)
+        if key not in self.index:
+            # Any None is a wildcard, resolve once and remember
+            for idx,rowkey in enumerate(self.keys):
+                if all(k is None or k==rk for k,rk in zip(key,rowkey)):
+                    self.index[key]=idx
+                    break
+            else:
+                raise KeyError('No calibration for %s'%', '.join('%s=%s'%(arg,k) for arg,k in zip(self.ARGKEYS,key)))
+        return self.index[key]
+
+    def coefficients(self,AMAC=None,Channel=None,BG=10,RG=3):
+        idx=self.lookup(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG)
+        return self.m[idx],self.b[idx]
+
+    def convert(self,count,AMAC=None,Channel=None,BG=10,RG=3):
+        m,b=self.coefficients(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG)
+        return m*count+b
+
+class LookupTable(CalibrationTable):
+    # CalibrationTable with the value of each of the NCODES ADC codes of every
+    # calibration precomputed, so that converting counts is a single gather.
+    # The tables take NCODES*8 bytes per calibration. Given the calibration
+    # sweep data, the mean residual of the linear fit (INL) in bins of inlbin
+    # codes is added, interpolated between the bins and held constant past
+    # the first and last one.
+    def __init__(self,calib,data=None,inlbin=32):
+        CalibrationTable.__init__(self,calib)
+        self.table=self.m[:,np.newaxis]*np.arange(NCODES)+self.b[:,np.newaxis]
+        if data is not None:
+            self.table+=self.inl(data,inlbin)
+
+    def rows(self,data):
+        # Table row of every point of data, -1 if its group has no calibration
+        g=data.groupby(list(self.ARGKEYS.values()),sort=True,observed=True)
+        grouprows=np.array([self.index.get(key,-1) for key in g.size().index]+[-1],dtype=int)
+        return grouprows[g.ngroup().fillna(-1).values.astype(int)] # Points with a missing key are in no group
+
+    def residuals(self,data):
+        # Row, code and residual of the sweep points used by calibrate()
+        row=self.rows(data)
+        count=data.ADCvalue.values.astype(int)
+        resid=data.InputVoltage.values-(self.m[row]*count+self.b[row])
+
+        xmax=np.where(data.RampGain.values==1,0.6,1.)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            used=(row>=0)&(data.InputVoltage.values<xmax)&(np.abs(resid/self.m[row])<16)
+        return row[used],count[used],resid[used]
+
+    def inl(self,data,inlbin=32):
+        # (calibrations, NCODES) correction of the linear conversion
+        row,count,resid=self.residuals(data)
+
+        nbins=NCODES//inlbin
+        flat=row*nbins+count//inlbin
+        n     =np.bincount(flat,minlength=len(self)*nbins).reshape(len(self),nbins)
+        sumres=np.bincount(flat,resid,minlength=len(self)*nbins).reshape(len(self),nbins)
+        sumcnt=np.bincount(flat,count,minlength=len(self)*nbins).reshape(len(self),nbins)
+
+        inl=np.zeros((len(self),NCODES))
+        codes=np.arange(NCODES)
+        for i in np.flatnonzero(n.sum(axis=1)):
+            filled=n[i]>0
+            inl[i]=np.interp(codes,sumcnt[i,filled]/n[i,filled],sumres[i,filled]/n[i,filled])
+        return inl
+
+    def gather(self,idx,count):
+        # Table value of each count of calibration idx. Counts that are not
+        # ADC codes (negative, past NCODES-1 or fractional) get the linear
+        # conversion, as with CalibrationTable.
+        count=np.asarray(count)
+        code=(count>=0)&(count<NCODES)&(np.mod(count,1)==0)
+        value=np.where(code,self.table[idx,np.where(code,count,0).astype(int)],self.m[idx]*count+self.b[idx])
+        return value[()]
+
+    def apply(self,data):
+        # Convert the ADCvalue of every point of data with its own calibration
+        row=self.rows(data)
+        if (row<0).any():
+            raise KeyError('No calibration for some of the points')
+        return self.gather(row,data.ADCvalue.values)
+
+    def convert(self,count,AMAC=None,Channel=None,BG=10,RG=3):
+        return self.gather(self.lookup(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG),count)
 
 def convert(count,calib,AMAC=None,BG=10,RG=3,Channel=None):
+    if isinstance(calib,CalibrationTable):
+        return calib.convert(count,AMAC=AMAC,Channel=Channel,BG=BG,RG=RG)
+
     if AMAC   !=None: calib=calib[calib.AMAC          ==AMAC   ]
     if Channel!=None: calib=calib[calib.Channel       ==Channel]
     if BG     !=None: calib=calib[calib.BandgapControl==BG     ]
@@ -45,6 +179,47 @@ def convert(count,calib,AMAC=None,BG=10,RG=3,Channel=None):
 
     return m*count+b
 
+class CalibrationFigure:
+    # Figure template for the calibration of one group. The axes and static
+    # decorations are drawn once, draw() only updates the data.
+    def __init__(self,fig=None):
+        self.fig=fig if fig is not None else Figure()
+
+        gs=self.fig.add_gridspec(3,3,hspace=0.,wspace=0.)
+
+        self.ax=self.fig.add_subplot(gs[0:2,:])
+        self.data,=self.ax.plot([],[],'.k')
+        self.fit ,=self.ax.plot([],[],'--b')
+        self.ax.set_ylabel('ADC counts')
+        self.ax.set_xlim(0,1.2)
+        self.ax.set_ylim(0,1024)
+        self.ax.set_xticks([])
+        self.info=self.ax.text(0.8,200,'',multialignment='left')
+
+        self.rax=self.fig.add_subplot(gs[2,:])
+        self.resid,=self.rax.plot([],[],'-b')
+        self.rax.plot([0,1.2],[0,0],'--k')
+        self.rax.set_xlim(0,1.2)
+        self.rax.set_ylim(-10,10)
+        self.rax.set_ylabel('Fit-Data')
+        self.rax.set_xlabel('Input Voltage [V]')
+
+    def draw(self,InputVoltage,ADCvalue,m,b,title):
+        self.data.set_data(InputVoltage,ADCvalue)
+        if m!=None:
+            self.fit  .set_data(InputVoltage,(InputVoltage-b)/m)
+            self.resid.set_data(InputVoltage,ADCvalue-(InputVoltage-b)/m)
+        else:
+            self.fit  .set_data([],[])
+            self.resid.set_data([],[])
+        self.ax.set_title(title)
+
+        info=[]
+        info.append('V = m ADC + b')
+        if m!=None: info.append('m = %0.2f mV/count'%(m*1000))
+        if b!=None: info.append('b = %0.2f mV'%(b*1000))
+        self.info.set_text('\n'.join(info))
+
 def plot_calibration(data,calib,AMAC=None,Channel=None,BG=None,RG=None):
     if AMAC!=None:
         data =data [data .AMAC==AMAC]
@@ -62,50 +237,20 @@ def plot_calibration(data,calib,AMAC=None,Channel=None,BG=None,RG=None):
         data =data [(data .RampGain==RG)]
         calib=calib[(calib.RampGain==RG)]
 
-    for amackey,amacgroup in data.groupby('AMAC'):
-        for bgkey,bggroup in amacgroup.groupby('BandgapControl'):
-            for rgkey,rggroup in bggroup.groupby('RampGain'):
-                for chkey,chgroup in rggroup.groupby('Channel'):
-                    # Retrieve the calibration
-                    thiscalib=calib[(calib.AMAC==amackey)&(calib.BandgapControl==bgkey)&(calib.RampGain==rgkey)&(calib.Channel==chkey)]
-
-                    m=None
-                    b=None
-                    if len(thiscalib)>0:
-                        m=thiscalib.m.iloc[0]
-                        b=thiscalib.b.iloc[0]
-
-                    # Plot the calibration
-                    plt.subplots_adjust(hspace=0.,wspace=0.)
-
-                    plt.subplot2grid((3,3), (0,0), rowspan=2, colspan=3)
-                    plt.plot(chgroup.InputVoltage,chgroup.ADCvalue,'.k')
-                    if m!=None: plt.plot(chgroup.InputVoltage,(chgroup.InputVoltage-b)/m,'--b')
-                    plt.ylabel('ADC counts')
-                    plt.xlim(0,1.2)
-                    plt.ylim(0,1024)
-                    plt.xticks([])
-                    plt.title('%s, %s, RampGain = %d, BandgapControl = %d'%(amackey,chkey,rgkey,bgkey))
-
-                    info=[]
-                    info.append('V = m ADC + b')
-                    if m!=None: info.append('m = %0.2f mV/count'%(m*1000))
-                    if b!=None: info.append('b = %0.2f mV'%(b*1000))
-                    plt.text(0.8,200,'\n'.join(info),multialignment='left')
-
-                    plt.subplot2grid((3,3), (2,0), rowspan=1, colspan=3)
-                    if m!=None:
-                        resid=chgroup.ADCvalue-(chgroup.InputVoltage-b)/m
-                        plt.plot(chgroup.InputVoltage,resid,'-b')
-                    plt.plot([0,1.2],[0,0],'--k')
-                    plt.xlim(0,1.2)
-                    plt.ylim(-10,10)
-                    plt.ylabel('Fit-Data')
-                    plt.xlabel('Input Voltage [V]')
-                    #plt.text(0.1,5,'diff %0.2f $\pm$ %0.2f mV'%(resid.mean()*1000,resid.std()*1000))
-                    #plt.text(0.5,5,'maxdiff %d mV'%((max(abs(resid.max()),abs(resid.min()))*1000)))
-
-                    plt.show()
+    calib=CalibrationTable(calib)
+
+    for (amackey,bgkey,rgkey,chkey),chgroup in data.groupby(['AMAC','BandgapControl','RampGain','Channel']):
+        # Retrieve the calibration
+        m=None
+        b=None
+        if (amackey,chkey,bgkey,rgkey) in calib.index:
+            m,b=calib.coefficients(amackey,chkey,bgkey,rgkey)
+
+        # Plot the calibration
+        CalibrationFigure(plt.gcf()).draw(chgroup.InputVoltage,chgroup.ADCvalue,m,b,
+                                          '%s, %s, RampGain = %d, BandgapControl = %d'%(amackey,chkey,rgkey,bgkey))
+
+        plt.show()
     
 def test_calibrate_perchip_perchannel(data,calib,AMAC=None,BG=10,RG=3):
     if AMAC!=None: data=data[data.AMAC==AMAC]
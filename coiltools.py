@@ -0,0 +1,118 @@
+import pandas as pd
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+import report
+
+#
+# Spectral analysis of the coil pickup traces recorded with the DC-DC
+# converter on (CoilLVON) and off (CoilLVOFF). The traces of all boards are
+# stacked into a (boards, samples) array, so that the spectra of the whole
+# fleet are a single batched real FFT.
+
+# Coil trace log families, see pbreport.FAMILIES
+FAMILIES={'CoilLVON' :('{PB}_CoilLVON.log' ,report.read_table),
+          'CoilLVOFF':('{PB}_CoilLVOFF.log',report.read_table)}
+
+def stack_traces(frames):
+    # Stack a list of time/coil tables into (dt, traces). Traces are cut to
+    # the shortest one and must share the same sampling period.
+    dts=np.array([data.time.iloc[1]-data.time.iloc[0] for data in frames])
+    if not np.allclose(dts,dts[0]):
+        raise ValueError('Coil traces have different sampling periods')
+
+    N=min([len(data.index) for data in frames])
+    traces=np.stack([data.coil.values[:N] for data in frames]).astype(float)
+    return dts[0],traces
+
+def load_traces(logdir='pblog',family='CoilLVON',names=None,backend=None):
+    # All traces of a family as (names, dt, traces), optionally restricted to
+    # a list of board names
+    if backend is not None:
+        data=backend.read(family,columns=['PB','time','coil'],PB=names)
+        if data is None: return [],None,np.empty((0,0))
+        groups=list(data.groupby('PB',sort=False))
+    else:
+        logs=report.scan_logs(logdir,{family:FAMILIES[family]})[family]
+        groups=[(name,report.read_table(path)) for name,channel,path in logs if names is None or name in names]
+        if len(groups)==0: return [],None,np.empty((0,0))
+
+    dt,traces=stack_traces([data for name,data in groups])
+    return [name for name,data in groups],dt,traces
+
+def spectrum(traces,dt,window=None,nperseg=None,noverlap=None):
+    # Single sided amplitude spectrum of each row of traces, returning the
+    # frequencies [MHz] and the amplitudes. The window is anything accepted
+    # by scipy.signal.get_window (None is rectangular). If nperseg is shorter
+    # than the traces, the power of overlapping segments is averaged (Welch).
+    traces=np.atleast_2d(traces)
+    N=traces.shape[-1]
+    if nperseg is None: nperseg=N
+    if noverlap is None: noverlap=nperseg//2 if nperseg<N else 0
+
+    segments=np.lib.stride_tricks.sliding_window_view(traces,nperseg,axis=-1)[...,::nperseg-noverlap,:]
+    w=np.ones(nperseg) if window is None else scipy.signal.get_window(window,nperseg)
+
+    X=scipy.fft.rfft(segments*w,axis=-1,workers=-1)
+    ampl=2.0/w.sum()*np.sqrt(np.mean(np.abs(X)**2,axis=-2))
+    freq=scipy.fft.rfftfreq(nperseg,dt)*1e-6
+    return freq,ampl
+
+def peaks(freq,ampl,n=5,fmin=None,fmax=None):
+    # Indices of the n highest local maxima of each row of ampl within
+    # [fmin,fmax], as a (rows, n) array padded with -1
+    ismax=np.zeros(ampl.shape,dtype=bool)
+    ismax[:,1:-1]=(ampl[:,1:-1]>ampl[:,:-2])&(ampl[:,1:-1]>=ampl[:,2:])
+    if fmin is not None: ismax&=(freq>=fmin)
+    if fmax is not None: ismax&=(freq<=fmax)
+
+    score=np.where(ismax,ampl,-np.inf)
+    idx=np.argsort(-score,axis=1,kind='stable')[:,:n]
+    return np.where(np.isfinite(np.take_along_axis(score,idx,axis=1)),idx,-1)
+
+class CoilSpectra:
+    # LVON and LVOFF spectra of a fleet of boards, as (boards, frequencies)
+    # arrays. Only boards with both traces are kept.
+    def __init__(self,logdir='pblog',names=None,backend=None,window=None,nperseg=None,noverlap=None):
+        onnames ,dton ,lvon =load_traces(logdir,'CoilLVON' ,names,backend)
+        offnames,dtoff,lvoff=load_traces(logdir,'CoilLVOFF',names,backend)
+
+        self.names=[name for name in onnames if name in offnames]
+        if len(self.names)==0:
+            raise ValueError('No boards with both LVON and LVOFF coil traces')
+        if not np.isclose(dton,dtoff):
+            raise ValueError('LVON and LVOFF coil traces have different sampling periods')
+        N=min(lvon.shape[1],lvoff.shape[1])
+
+        self.dt=dton
+        self.traces_lvon =lvon [[onnames .index(name) for name in self.names],:N]
+        self.traces_lvoff=lvoff[[offnames.index(name) for name in self.names],:N]
+
+        # Both families in one batch
+        self.freq,ampl=spectrum(np.concatenate([self.traces_lvon,self.traces_lvoff]),self.dt,window,nperseg,noverlap)
+        self.lvon =ampl[:len(self.names)]
+        self.lvoff=ampl[len(self.names):]
+        self.diff =self.lvon-self.lvoff
+
+    def table(self):
+        # Long table of PB, freq, lvon, lvoff and diff
+        return pd.DataFrame({'PB'   :np.repeat(self.names,len(self.freq)),
+                             'freq' :np.tile(self.freq,len(self.names)),
+                             'lvon' :self.lvon .ravel(),
+                             'lvoff':self.lvoff.ravel(),
+                             'diff' :self.diff .ravel()})
+
+    def peaks(self,n=5,fmin=1e-2,fmax=1e2,spectrum='diff'):
+        # Table of the n highest peaks of one spectrum of each board
+        ampl=getattr(self,spectrum)
+        idx=peaks(self.freq,ampl,n,fmin,fmax)
+
+        board,rank=np.nonzero(idx>=0)
+        idx=idx[board,rank]
+        return pd.DataFrame({'PB'   :np.array(self.names)[board],
+                             'rank' :rank,
+                             'freq' :self.freq[idx],
+                             'lvon' :self.lvon [board,idx],
+                             'lvoff':self.lvoff[board,idx],
+                             'diff' :self.diff [board,idx]})
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+
+import report
+import calibcache
+import calibstore
+import plotbatch
+import instrument
+
+import calibtools
+import icalibtools
+
+#
+# Voltage (calib) and current (icalib) ADC calibration of all AMACs in a
+# single pass. Each chip is loaded once, parsing only the sections needed by
+# the calibrations it gets.
+
+def fit_calib(reports):
+    return calibtools.calibrate(reports.calib)
+
+def fit_icalib(reports):
+    # The fixCalib fit is batched over all groups and runs serially
+    icalib=icalibtools.calibrate(reports.icalib,fixCalib=True)
+
+    failed=icalib[icalib.status!='ok']
+    for idx,row in failed.iterrows():
+        print('WARNING: %s for AMAC=%s, Channel=%s, BandgapControl=%d, RampGain=%d, OpAmpGain=%d.'%(row.status,row.AMAC,row.Channel,row.BandgapControl,row.RampGain,row.OpAmpGain))
+    return icalib[icalib.status=='ok'].drop(columns='status')
+
+def chunks(names,size=None):
+    # Consecutive chunks of size names, a single chunk if size is None
+    if not size: return [names]
+    return [names[i:i+size] for i in range(0,len(names),size)]
+
+# Report section and fit of each calibration
+CALIBRATIONS={'calib' :('calib' ,fit_calib ),
+              'icalib':('icalib',fit_icalib)}
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Fit the ADC voltage and current calibrations of all AMACs.')
+    parser.add_argument('--calibrations',nargs='+',choices=list(CALIBRATIONS),default=list(CALIBRATIONS),help='Calibrations to run')
+    parser.add_argument('--chips'      ,nargs='+',default=['AMAC_???']     ,help='Chip name patterns')
+    parser.add_argument('--jobs'       ,type=int,default=os.cpu_count()    ,help='Worker processes loading the logs and rendering the plots, the fits run serially')
+    parser.add_argument('--log'        ,default='log'                      ,help='AMAC test log directory')
+    parser.add_argument('--output'     ,default='data/calib'               ,help='Calibration output directory')
+    parser.add_argument('--imgdir'     ,default='img'                      ,help='Plot output directory')
+    parser.add_argument('--no-plots'   ,action='store_true'                ,help='Do not render the calibration plots')
+    parser.add_argument('--chunk-size' ,type=int,default=None              ,help='Load and fit this many chips at a time, bounding the memory use (default: all at once)')
+    parser.add_argument('--incremental',action='store_true'                ,help='Only refit chips whose calibration logs changed since the last run')
+    parser.add_argument('--instrument' ,nargs='?',const='instrument.jsonl',default=None,metavar='PATH',help='Record the time, rows and bytes read (rchar) of each stage to PATH')
+    parser.add_argument('--instrument-memory',action='store_true',help='Also trace the peak memory of each stage, which slows the run down several times')
+    args=parser.parse_args(argv)
+
+    if args.instrument:
+        instrument.enable(args.instrument,memory=args.instrument_memory)
+
+    #
+    # Find all of the available AMAC tests, and the chips to fit for each
+    # calibration
+    with instrument.stage('scan_logs'):
+        index=report.index_logs(report.scan_logs(args.log))
+        names=sorted(set().union(*[report.match_names(index,pattern,'GeneralParams') for pattern in args.chips]))
+
+    cache=calibcache.CalibCache(args.output,args.log,index=index)
+    todo={}
+    for kind in args.calibrations:
+        todo[kind]=[name for name in names if calibcache.INPUTS[kind] in index[name]]
+        if args.incremental:
+            skipped=[name for name in todo[kind] if cache.isvalid(name,kind)!=None]
+            todo[kind]=[name for name in todo[kind] if name not in skipped]
+            print('%s: Skipping %d unchanged chips: %s'%(kind,len(skipped),' '.join(skipped)))
+
+    #
+    # Load each chip once, with the sections of its calibrations
+    sections={}
+    for kind in args.calibrations:
+        for name in todo[kind]:
+            sections.setdefault(name,[]).append(CALIBRATIONS[kind][0])
+    if len(sections)==0:
+        print('Nothing to calibrate')
+        return
+
+    #
+    # Chips are loaded, fitted, stored and released one chunk at a time, so
+    # that the peak memory is that of the largest chunk
+    fitted=set()
+    for chunk in chunks(sorted(sections),args.chunk_size):
+        # Fingerprint the inputs before they are read, so that a log written
+        # during the fit makes its calibration out of date
+        inputs={}
+        for kind in args.calibrations:
+            for name in chunk:
+                if name not in todo[kind]: continue
+                manifest=cache.manifest(name,kind)
+                inputs[(name,kind)]=calibcache.fingerprint(cache.inputs(name,kind),manifest['inputs'] if manifest!=None else None)
+
+        with instrument.stage('Reports.from_index',rows=len(chunk)):
+            reports=report.Reports.from_index(index,chunk,args.log,jobs=args.jobs,sections=sections)
+
+        for kind in args.calibrations:
+            section,fit=CALIBRATIONS[kind]
+            kindreports=report.Reports([r for r in reports.reports if r.name in todo[kind]])
+            if len(kindreports.names)==0: continue
+
+            #
+            # Perform the calibration
+            with instrument.stage('%s.fit'%kind,rows=len(getattr(kindreports,section))):
+                calib=fit(kindreports)
+
+            #
+            # Save data
+            with instrument.stage('%s.store'%kind,rows=len(calib)):
+                for amackey,amacgroup in calib.groupby('AMAC',observed=True):
+                    cache.store(amackey,amacgroup,kind,inputs[(amackey,kind)])
+            fitted.add(kind)
+
+            #
+            # Save pretty images
+            if not args.no_plots:
+                with instrument.stage('%s.render'%kind):
+                    rendered=plotbatch.render(getattr(kindreports,section),calib,kind,imgdir=args.imgdir,jobs=args.jobs)
+                print('%s: Rendered %d images'%(kind,len(rendered)))
+
+        del reports,kindreports
+
+    for kind in sorted(fitted):
+        with instrument.stage('%s.build'%kind):
+            calibstore.build(args.output,kind)
+
+    if args.instrument:
+        instrument.summary()
+
+if __name__=='__main__':
+    main()
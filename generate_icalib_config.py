@@ -1,38 +1,9 @@
 #!/usr/bin/env python 
 
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
+import sys
 
-import glob
-import re
-
-import report
-
-import icalibtools
-
-re_generalparams=re.compile('log/(AMAC_[a-zA-Z0-9]+)_GeneralParams.log')
-
-#
-# Find all of the available AMAC tests
-reports=[]
-for path in glob.glob('log/AMAC_???_GeneralParams.log'):
-    match=re_generalparams.match(path)
-    reports.append(report.Report(match.group(1)))
-reports=report.Reports(reports)
-
-#
-# Perform the calibration
-icalib=icalibtools.calibrate(reports.icalib,fixCalib=True)
-
-#
-# Save data
-for amackey,amacgroup in icalib.groupby('AMAC'):
-    amacgroup.to_csv('data/calib/icalib_%s.csv'%amackey, index=False)
+import generate_config
 
 #
-# Save pretty images
-for ckey,cdata in reports.icalib.groupby(['AMAC','Channel','BandgapControl','RampGain','OpAmpGain']):
-    icalibtools.plot_calibration(cdata,icalib,ckey[0],ckey[1],ckey[2],ckey[3])
-    plt.show()
-    plt.savefig('img/icalib_%s_%s_BandgapControl%d_RampGain%d_OpAmpGain%d.png'%ckey)
+# Current calibration only, see generate_config.py for the options
+generate_config.main(['--calibrations','icalib']+sys.argv[1:])
@@ -0,0 +1,34 @@
+#!/usr/bin/env python 
+
+import os
+import sys
+
+import report
+
+import noisetools
+
+#
+# Find all of the available noise tests
+index=report.index_logs(report.scan_logs('log'))
+names=report.match_names(index,'*','noise')
+
+reports=report.Reports.from_index(index,names,jobs=os.cpu_count(),sections=['noise'])
+if len(reports.names)==0:
+    print('No noise data')
+    sys.exit(0)
+
+#
+# Reduce to code histograms
+hists=noisetools.NoiseHistograms.from_data(reports.noise)
+stats=noisetools.outliers(hists.stats())
+
+#
+# Save data
+os.makedirs('data/noise',exist_ok=True)
+hists.to_csv('data/noise/histograms.csv')
+stats.to_csv('data/noise/stats.csv', index=False)
+
+outliers=stats[stats.outlier]
+print('%d groups, %d outliers'%(len(stats),len(outliers)))
+for idx,row in outliers.iterrows():
+    print('%s %s: rms = %0.2f'%(row.AMAC,row.Channel,row.rms))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+import pandas as pd
+
+import argparse
+import base64
+import contextlib
+import html
+import io
+import json
+import os, os.path
+import re
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import report
+import pbreport
+import calibcache
+import calibtools
+import instrument
+
+#
+# Static HTML versions of TestReport.ipynb and PowerBoardReport.ipynb for
+# every AMAC and power board, rendered without a kernel. Each section runs the
+# same render_* method as the notebook, with its printed text, HTML tables and
+# figures collected into the page. A manifest in the output directory keeps
+# the fingerprint of the input logs of each page, so that only pages whose
+# inputs changed are rendered again.
+
+# Sections of each report, as (title, render method name)
+AMAC_SECTIONS=[('General Parameters'                       ,'render_genparam'            ),
+               ('I2C'                                      ,'render_i2c'                 ),
+               ('Bandgap'                                  ,'render_bgo'                 ),
+               ('Noise'                                    ,'render_noise'               ),
+               ('Voltage Calibration, RampGain'            ,'render_calib_rampgain'      ),
+               ('Voltage Calibration, BandgapControl'      ,'render_calib_bandgapcontrol'),
+               ('Current Calibration'                      ,'render_icalib'              ),
+               ('Clock'                                    ,'render_clk'                 )]
+
+PB_SECTIONS  =[('General'                                  ,'render_general'             ),
+               ('DC-DC Efficiency'                         ,'render_dcdceff'             ),
+               ('Input Voltage'                            ,'render_vin'                 ),
+               ('Input Current'                            ,'render_viniin'              ),
+               ('Output Current'                           ,'render_iout'                ),
+               ('Leakage Current'                          ,'render_ileak'               ),
+               ('Coil'                                     ,'render_coil'                )]
+
+# Matplotlib warnings of the render methods on sparse data, not shown
+IGNOREDWARNINGS=['No artists with labels found to put in legend',
+                 'Attempt to set non-positive']
+
+PAGE='''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>body {{font-family: sans-serif}} img {{max-width: 100%}} .error {{color: red}}</style>
+</head><body>
+<h1>{title}</h1>
+{body}
+</body></html>
+'''
+
+def _img(fig):
+    # Figure as an embedded PNG
+    buf=io.BytesIO()
+    fig.savefig(buf,format='png')
+    return '<img src="data:image/png;base64,%s">'%base64.b64encode(buf.getvalue()).decode()
+
+def _body(markup):
+    # Contents of the <body> of the HTML documents built by the render methods
+    match=re.search('<body>(.*)</body>',markup,re.DOTALL)
+    return match.group(1) if match!=None else markup
+
+@contextlib.contextmanager
+def capture(parts):
+    # Collect the output of notebook render methods into parts: plt.show()
+    # and display() append the current figure or HTML instead of showing it.
+    def show(*args,**kwargs):
+        fig=plt.gcf()
+        if len(fig.axes)>0: parts.append(_img(fig))
+        plt.close(fig)
+
+    def display(obj):
+        parts.append(_body(obj.data))
+
+    saved=plt.show,report.display,pbreport.display
+    plt.show=show
+    report.display=pbreport.display=display
+    try:
+        yield
+        show()
+    finally:
+        plt.show,report.display,pbreport.display=saved
+        plt.close('all')
+
+def render_section(obj,title,method):
+    # One section of a page. Exceptions (ie: a missing log) are shown in the
+    # section instead of failing the whole report.
+    parts=[]
+    stdout=io.StringIO()
+    try:
+        with capture(parts), contextlib.redirect_stdout(stdout), warnings.catch_warnings():
+            for message in IGNOREDWARNINGS:
+                warnings.filterwarnings('ignore',message=message,category=UserWarning)
+            getattr(obj,method)()
+    except Exception as e:
+        parts.append('<pre class="error">%s</pre>'%html.escape(''.join(traceback.format_exception_only(type(e),e)).strip()))
+    if stdout.getvalue():
+        parts.insert(0,'<pre>%s</pre>'%html.escape(stdout.getvalue()))
+    return '<h2>%s</h2>\n%s'%(html.escape(title),'\n'.join(parts))
+
+def render_page(obj,title,sections):
+    plt.rcParams.update({'figure.figsize':(12,8),'font.size':15})
+    body='\n'.join([render_section(obj,sectiontitle,method) for sectiontitle,method in sections])
+    return PAGE.format(title=html.escape(title),body=body)
+
+def write(path,page):
+    with open(path+'.tmp','w') as fh:
+        fh.write(page)
+    os.replace(path+'.tmp',path)
+
+def _amacname(name):
+    # AMAC of a power board, ie: AMAC_A07 of PB_AMAC_A07_TEST, None if unknown
+    match=pbreport.re_amac.match(name)
+    return match.group(1) if match!=None else None
+
+def _calibration(AMAC,calibdir,logdir):
+    # Voltage calibration of an AMAC, read from calibdir or, if it is not
+    # there, fitted from its logs. Nothing is written, the calibrations are
+    # stored by generate_config.py.
+    if AMAC==None:
+        return pd.DataFrame(columns=calibtools.CALIBKEYS+['m','b'])
+    cache=calibcache.CalibCache(calibdir,logdir)
+    if os.path.exists(cache.csvpath(AMAC)):
+        return pd.read_csv(cache.csvpath(AMAC),float_precision='round_trip')
+    if len(cache.inputs(AMAC))==0:
+        return pd.DataFrame(columns=calibtools.CALIBKEYS+['m','b'])
+    return calibtools.calibrate(report.Report(AMAC,logdir).calib)
+
+def _render_task(task):
+    # Render and write one page, returning an error message on failure
+    kind,name,path,logdir,logs,backend,calibdir,amaclogdir=task
+    try:
+        if backend!=None:
+            import ingest
+            backend=ingest.ColumnarBackend(backend)
+        with instrument.stage('htmlreport.%s'%kind,name=name):
+            if kind=='amac':
+                page=render_page(report.Report(name,logdir,backend=backend,logs=logs),name,AMAC_SECTIONS)
+            else:
+                calib=_calibration(_amacname(name),calibdir,amaclogdir)
+                page=render_page(pbreport.Report(name,logdir,backend=backend,calib=calib),name,PB_SECTIONS)
+        write(path,page)
+        return None
+    except Exception as e:
+        return ''.join(traceback.format_exception_only(type(e),e)).strip()
+
+def _index(output,pages):
+    rows=''.join(['<tr><td><a href="%s">%s</a></td></tr>'%(html.escape(os.path.basename(path)),html.escape(name)) for name,path in pages])
+    write(os.path.join(output,'index.html'),PAGE.format(title='Test Reports',body='<table>%s</table>'%rows))
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Render the AMAC and power board test reports as static HTML.')
+    parser.add_argument('--chips'     ,nargs='+',default=['AMAC_???']   ,help='AMAC name patterns')
+    parser.add_argument('--boards'    ,nargs='+',default=['PB_AMAC_*'  ],help='Power board name patterns')
+    parser.add_argument('--log'       ,default='log'                    ,help='AMAC test log directory')
+    parser.add_argument('--pblog'     ,default='pblog'                  ,help='Power board test log directory')
+    parser.add_argument('--backend'   ,default=None                     ,help='Read the AMAC logs from a columnar dataset written by ingest.py')
+    parser.add_argument('--calib'     ,default='data/calib'             ,help='Calibration cache directory')
+    parser.add_argument('--output'    ,default='html'                   ,help='Report output directory')
+    parser.add_argument('--jobs'      ,type=int,default=os.cpu_count()  ,help='Worker processes')
+    parser.add_argument('--force'     ,action='store_true'              ,help='Render all reports, even if their inputs did not change')
+    parser.add_argument('--instrument',nargs='?',const='instrument.jsonl',default=None,metavar='PATH',help='Record the time of each report to PATH')
+    parser.add_argument('--instrument-memory',action='store_true',help='Also trace the peak memory of each report, which slows the rendering down')
+    args=parser.parse_args(argv)
+
+
+    if args.instrument:
+        instrument.enable(args.instrument,memory=args.instrument_memory)
+
+    #
+    # Find all reports, and the input logs of each. A power board page also
+    # depends on the voltage calibration of its AMAC and its logs.
+    index  =report.index_logs(report.scan_logs(args.log))
+    pbindex=report.index_logs(report.scan_logs(args.pblog,pbreport.FAMILIES))
+    paths=lambda logs: [path for familylogs in logs.values() for name,channel,path in familylogs]
+
+    tasks={}
+    for name in sorted(set().union(*[report.match_names(index,pattern,'GeneralParams') for pattern in args.chips])):
+        tasks[name]=(('amac',name,os.path.join(args.output,'%s.html'%name),args.log,index[name],args.backend,args.calib,args.log),paths(index[name]))
+    for name in sorted(set().union(*[report.match_names(pbindex,pattern) for pattern in args.boards])):
+        amacname=_amacname(name)
+        inputs=paths(pbindex[name])+paths({family:logs for family,logs in index.get(amacname,{}).items() if family==calibcache.INPUTS['calib']})
+        csvpath=calibcache.CalibCache(args.calib).csvpath(amacname)
+        if amacname!=None and os.path.exists(csvpath): inputs.append(csvpath)
+        tasks[name]=(('pb',name,os.path.join(args.output,'%s.html'%name),args.pblog,None,args.backend,args.calib,args.log),inputs)
+
+    #
+    # Skip the pages whose inputs are unchanged
+    os.makedirs(args.output,exist_ok=True)
+    manifestpath=os.path.join(args.output,'manifest.json')
+    manifest={}
+    if os.path.exists(manifestpath):
+        with open(manifestpath) as fh:
+            manifest=json.load(fh)
+
+    fingerprints={}
+    todo=[]
+    for name,(task,inputs) in tasks.items():
+        fingerprints[name]=calibcache.fingerprint(inputs,manifest.get(name))
+        if not args.force and name in manifest and os.path.exists(task[2]) and calibcache.samefiles(fingerprints[name],manifest[name]):
+            continue
+        todo.append(name)
+    print('Rendering %d reports, %d unchanged'%(len(todo),len(tasks)-len(todo)))
+
+    #
+    # Render
+    if args.jobs>1 and len(todo)>1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            errors=list(executor.map(_render_task,[tasks[name][0] for name in todo]))
+    else:
+        errors=[_render_task(tasks[name][0]) for name in todo]
+
+    for name,error in zip(todo,errors):
+        if error!=None:
+            print('WARNING: Failed to render %s: %s'%(name,error))
+            manifest.pop(name,None)
+        else:
+            manifest[name]=fingerprints[name]
+    for name in tasks:
+        if name not in todo: manifest[name]=fingerprints[name]
+
+    with open(manifestpath+'.tmp','w') as fh:
+        json.dump(manifest,fh,indent=1)
+    os.replace(manifestpath+'.tmp',manifestpath)
+
+    _index(args.output,[(name,tasks[name][0][2]) for name in tasks if name in manifest])
+
+    if args.instrument:
+        instrument.summary()
+
+if __name__=='__main__':
+    main()
@@ -1,10 +1,14 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
 
 import glob, re
 
+import calibtools
+import instrument
+
 # Ideal limits for each OpAmpGain setting
 # key is floor(OA/2), value is in Amp
 ILIMITS={0: 1e-5,
@@ -17,79 +21,244 @@ ILIMITS={0: 1e-5,
          7: 3e-3,
          8: 3e-3}
 
+# Search range of the internal resistance RI [Ohm] in the fixCalib fit
+RIBOUNDS=(0.,1000.)
+
+CALIBKEYS=['AMAC','Channel','BandgapControl','RampGain','OpAmpGain']
 
 def currentcalib(subdata, m, b, Voff, RI):
     Rtot=(subdata.ResistorValue+60+RI)
     return ((Rtot*(m*subdata.ADCvalue+b)+Voff)/(subdata.ResistorValue+60)).tolist()
 
-def calibrate(data, fixCalib=False):
-    calibs=pd.DataFrame(columns=['AMAC','Channel','BandgapControl','RampGain','OpAmpGain','m','b','Voff','RI'])
-
-    for amackey,amacgroup in data.groupby('AMAC'):
-        for chkey,chgroup in amacgroup.groupby('Channel'):
-            for bgkey,bggroup in chgroup.groupby('BandgapControl'):
-                for rgkey,rggroup in bggroup.groupby('RampGain'):
-                    for oakey,oagroup in rggroup.groupby('OpAmpGain'):
-                        # Remove any saturated region
-                        subdata=oagroup[oagroup.InputCurrent<ILIMITS.get(int(oakey/2),1)].dropna()
-
-                        if fixCalib:
-                            # Initial fit using a linear relationship
-                            Voff=-0.1
-                            RI=50
-                            CorrectedInputCurrent=(subdata.InputCurrent*(subdata.ResistorValue+60)-Voff)/((subdata.ResistorValue+60)+RI)
-                            m,b=np.polyfit(pd.to_numeric(subdata.ADCvalue),CorrectedInputCurrent,1)
-
-                            # Filter out bad guys, pass 1
-                            try:
-                                filtsubdata=subdata[abs(subdata.ADCvalue-(CorrectedInputCurrent-b)/m)<512]
-                                popt, pcov = curve_fit(currentcalib, filtsubdata, filtsubdata.InputCurrent,p0=(m,b,Voff,RI),bounds=((0,-np.inf,-np.inf,0),(np.inf,np.inf,np.inf,np.inf)))
-                                m,b,Voff,RI=popt
-                                CorrectedInputCurrent=(subdata.InputCurrent*(subdata.ResistorValue+60)-Voff)/((subdata.ResistorValue+60)+RI)
-                            except:
-                                print('WARNING: Fit failed for for AMAC=%s, Channel=%s, BandgapControl=%d, RampGain=%d, OpAmpGain=%d.'%(amackey,chkey,bgkey,rgkey,oakey))
-                                continue
-
-                            # Filter out bad guys, pass 2
-                            try:
-                                filtsubdata=subdata[abs(subdata.ADCvalue-(CorrectedInputCurrent-b)/m)<8]
-                                filtCorrectedInputCurrent=(filtsubdata.InputCurrent*(filtsubdata.ResistorValue+60)-Voff)/((filtsubdata.ResistorValue+60)+RI)
-                                popt, pcov = curve_fit(currentcalib, filtsubdata, filtsubdata.InputCurrent,p0=(m,b,Voff,RI),bounds=((0,-np.inf,-np.inf,0),(np.inf,np.inf,np.inf,np.inf)))
-                                m,b,Voff,RI=popt
-                            except:
-                                print('WARNING: Filtered fit failed for for AMAC=%s, Channel=%s, BandgapControl=%d, RampGain=%d, OpAmpGain=%d.'%(amackey,chkey,bgkey,rgkey,oakey))
-                                continue
-
-                        else:
-                            Voff=-0.1
-                            RI=50
-                            CorrectedInputCurrent=(subdata.InputCurrent*(subdata.ResistorValue+60)-Voff)/((subdata.ResistorValue+60)+RI)
-                            m,b=np.polyfit(pd.to_numeric(subdata.ADCvalue),CorrectedInputCurrent,1)
-
-                            # Filter out bad guys
-                            filtsubdata=subdata[abs(subdata.ADCvalue-(CorrectedInputCurrent-b)/m)<16]
-                            filtCorrectedInputCurrent=(filtsubdata.InputCurrent*(filtsubdata.ResistorValue+60)-Voff)/((filtsubdata.ResistorValue+60)+RI)
-                            if len(filtsubdata)==0:
-                                print('WARNING: No data after filter for AMAC=%s, Channel=%s, BandgapControl=%d, RampGain=%d, OpAmpGain=%d.'%(amackey,chkey,bgkey,rgkey,oakey))
-                                continue
-
-                            m,b=np.polyfit(pd.to_numeric(filtsubdata.ADCvalue),filtCorrectedInputCurrent,1)
-
-                        # Save the results
-                        calibs=calibs.append({'AMAC':amackey,
-                                              'Channel':chkey,
-                                              'BandgapControl':bgkey,
-                                              'RampGain':rgkey,
-                                              'OpAmpGain':oakey,
-                                              'm':m,
-                                              'b':b,
-                                              'Voff':Voff,
-                                              'RI':RI},
-                                             ignore_index=True)
-
+def _correctedcurrent(InputCurrent, Rload, Voff, RI):
+    return (InputCurrent*Rload-Voff)/(Rload+RI)
+
+def _solve(gid,ngroups,X,y):
+    # Least squares solution of y=X theta in every group at once, from the
+    # grouped sums of the normal equations. The normal equations are scaled
+    # to a unit diagonal. Returns theta, the sum of squared residuals and
+    # whether each group had a unique solution.
+    k=X.shape[1]
+    M=np.empty((ngroups,k,k))
+    r=np.empty((ngroups,k))
+    for i in range(k):
+        r[:,i]=np.bincount(gid,X[:,i]*y,minlength=ngroups)
+        for j in range(i,k):
+            M[:,i,j]=M[:,j,i]=np.bincount(gid,X[:,i]*X[:,j],minlength=ngroups)
+
+    d=np.sqrt(np.einsum('gii->gi',M))
+    d=np.divide(1,d,out=np.zeros_like(d),where=d>0)
+    M*=d[:,:,np.newaxis]*d[:,np.newaxis,:]
+    ok=np.abs(np.linalg.det(M))>1e-12
+    M[~ok]=np.eye(k)
+    theta=np.linalg.solve(M,(r*d)[:,:,np.newaxis])[:,:,0]*d
+
+    resid=y-np.einsum('ni,ni->n',X,theta[gid])
+    return theta,np.bincount(gid,resid**2,minlength=ngroups),ok
+
+def _fitlinear(gid,ngroups,A,u,I,RI):
+    # m, b and Voff of every group at fixed RI, to which the current model is
+    # linear: I = m A (1+RI u) + b (1+RI u) + Voff u with u=1/Rload
+    s=1+RI[gid]*u
+    return _solve(gid,ngroups,np.stack([A*s,s,u],axis=1),I)
+
+def _searchRI(gid,ngroups,A,u,I,bounds=RIBOUNDS,xtol=1e-6):
+    # Bounded golden section search of the RI minimizing the residuals of
+    # _fitlinear, in all groups at once and with a fixed number of steps
+    invphi=(np.sqrt(5)-1)/2
+    a=np.full(ngroups,float(bounds[0]))
+    b=np.full(ngroups,float(bounds[1]))
+    c=b-invphi*(b-a)
+    d=a+invphi*(b-a)
+    fc=_fitlinear(gid,ngroups,A,u,I,c)[1]
+    fd=_fitlinear(gid,ngroups,A,u,I,d)[1]
+    for step in range(int(np.ceil(np.log(xtol/(bounds[1]-bounds[0]))/np.log(invphi)))):
+        left=fc<fd
+        a,b=np.where(left,a,c),np.where(left,d,b)
+        x=np.where(left,b-invphi*(b-a),a+invphi*(b-a))
+        fx=_fitlinear(gid,ngroups,A,u,I,x)[1]
+        c,fc,d,fd=np.where(left,x,d),np.where(left,fx,fd),np.where(left,c,x),np.where(left,fc,fx)
+    return (a+b)/2
+
+def _fitpass(gid,ngroups,A,u,I,Voff,RI):
+    # Variable projection fit of the current model to the points of each
+    # group. RI is only constrained by the data if a group has several load
+    # resistors. With a single one, RI and Voff are degenerate with m and b
+    # and are kept at their current values.
+    umin=np.full(ngroups, np.inf); np.minimum.at(umin,gid,u)
+    umax=np.full(ngroups,-np.inf); np.maximum.at(umax,gid,u)
+    varying=umax>umin
+
+    if varying.any():
+        search=varying[gid]
+        RI=np.where(varying,_searchRI(gid[search],ngroups,A[search],u[search],I[search]),RI)
+    theta,sse,ok=_fitlinear(gid,ngroups,A,u,I,RI)
+    Voff=np.where(varying,theta[:,2],Voff)
+
+    s=1+RI[gid]*u
+    fixed,sse,fixedok=_solve(gid,ngroups,np.stack([A*s,s],axis=1),I-Voff[gid]*u)
+    m =np.where(varying,theta[:,0],fixed[:,0])
+    b =np.where(varying,theta[:,1],fixed[:,1])
+    ok=np.where(varying,ok,fixedok)&(m>0)
+    return m,b,Voff,RI,ok
+
+def fitgroups(gid,ngroups,InputCurrent,ResistorValue,ADCvalue):
+    # fixCalib fit of all groups at once, with gid the group index of every
+    # point. Same steps as fitgroup: an initial linear fit of the corrected
+    # current at Voff=-0.1 and RI=50, then two fits of the full model after
+    # removing points more than 512 and 8 counts away from the previous one.
+    # Returns arrays of m, b, Voff, RI and status.
+    A=ADCvalue
+    Rload=ResistorValue+60
+    u=1/Rload
+
+    status=np.full(ngroups,'ok',dtype=object)
+    status[np.bincount(gid,minlength=ngroups)==0]='no data'
+
+    Voff=np.full(ngroups,-0.1)
+    RI  =np.full(ngroups,50.)
+    CorrectedInputCurrent=_correctedcurrent(InputCurrent,Rload,Voff[gid],RI[gid])
+    theta,sse,ok=_solve(gid,ngroups,np.stack([np.ones_like(A),A],axis=1),CorrectedInputCurrent)
+    b,m=theta.T
+    status[(~ok)&(status=='ok')]='fit failed'
+    for cut,failure in [(512,'fit failed'),(8,'filtered fit failed')]:
+        with np.errstate(divide='ignore',invalid='ignore'):
+            filt=np.abs(A-(CorrectedInputCurrent-b[gid])/m[gid])<cut
+        m,b,Voff,RI,ok=_fitpass(gid[filt],ngroups,A[filt],u[filt],InputCurrent[filt],Voff,RI)
+        status[(~ok)&(status=='ok')]=failure
+        CorrectedInputCurrent=_correctedcurrent(InputCurrent,Rload,Voff[gid],RI[gid])
+
+    failed=status!='ok'
+    m[failed]=b[failed]=Voff[failed]=RI[failed]=np.nan
+    return m,b,Voff,RI,status
+
+def fitgroup(InputCurrent, ResistorValue, ADCvalue, fixCalib=False):
+    # Fit a single (AMAC, Channel, BG, RG, OpAmpGain) group. Works on plain
+    # arrays so that groups can be shipped to worker processes. Returns the
+    # fit parameters and a status string, 'ok' if the fit succeeded.
+    if len(ADCvalue)==0:
+        return (np.nan,np.nan,np.nan,np.nan,'no data')
+
+    if fixCalib:
+        m,b,Voff,RI,status=fitgroups(np.zeros(len(ADCvalue),dtype=int),1,InputCurrent,ResistorValue,ADCvalue)
+        return (m[0],b[0],Voff[0],RI[0],status[0])
+
+    # Initial fit using a linear relationship
+    Rload=ResistorValue+60
+    Voff=-0.1
+    RI=50
+    CorrectedInputCurrent=_correctedcurrent(InputCurrent,Rload,Voff,RI)
+    m,b=np.polyfit(ADCvalue,CorrectedInputCurrent,1)
+
+    # Filter out bad guys
+    filt=abs(ADCvalue-(CorrectedInputCurrent-b)/m)<16
+    if not filt.any():
+        return (np.nan,np.nan,np.nan,np.nan,'no data after filter')
+
+    m,b=np.polyfit(ADCvalue[filt],CorrectedInputCurrent[filt],1)
+    return (m,b,Voff,RI,'ok')
+
+def _fitgroup_task(task):
+    key,args=task[0],task[1:]
+    with instrument.stage('icalibtools.fitgroup',group=key,rows=len(args[0])) as record:
+        result=fitgroup(*args)
+        record['status']=result[-1]
+    return result
+
+def calibrate(data, fixCalib=False, jobs=1):
+    # Fit every (AMAC, Channel, BG, RG, OpAmpGain) group. The fixCalib fit of
+    # all groups is batched and runs serially in this process, jobs only
+    # parallelizes the per-group fits of fixCalib=False.
+    # Remove any saturated region
+    data=data[CALIBKEYS+['InputCurrent','ResistorValue','ADCvalue']]
+    ilimit=(data.OpAmpGain//2).map(ILIMITS).fillna(1)
+    data=data[data.InputCurrent<ilimit].dropna()
+
+    if fixCalib:
+        # All groups are fitted at once, in this process
+        g=data.groupby(CALIBKEYS,observed=True)
+        calibs=g.size().index.to_frame(index=False)
+        with instrument.stage('icalibtools.fitgroups',groups=len(calibs),rows=len(data)):
+            results=fitgroups(g.ngroup().values,len(calibs),
+                              data.InputCurrent .values.astype(float),
+                              data.ResistorValue.values.astype(float),
+                              data.ADCvalue     .values.astype(float))
+        for column,result in zip(['m','b','Voff','RI','status'],results):
+            calibs[column]=result
+        return calibs
+
+    keys=[]
+    tasks=[]
+    for key,group in data.groupby(CALIBKEYS):
+        keys.append(key)
+        tasks.append((key,
+                      group.InputCurrent .values.astype(float),
+                      group.ResistorValue.values.astype(float),
+                      group.ADCvalue     .values.astype(float),
+                      fixCalib))
+
+    if jobs>1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results=list(executor.map(_fitgroup_task,tasks,chunksize=max(1,len(tasks)//(4*jobs))))
+    else:
+        results=[_fitgroup_task(task) for task in tasks]
+
+    # Save the results, one row per group with the fit status
+    calibs=pd.DataFrame([key+result for key,result in zip(keys,results)],
+                        columns=CALIBKEYS+['m','b','Voff','RI','status'])
     return calibs
 
+class CalibrationTable(calibtools.CalibrationTable):
+    ARGKEYS={'AMAC'   :'AMAC',
+             'Channel':'Channel',
+             'BG'     :'BandgapControl',
+             'RG'     :'RampGain',
+             'OA'     :'OpAmpGain'}
+
+    def __init__(self,calib):
+        calibtools.CalibrationTable.__init__(self,calib)
+        self.Voff=self.calib.Voff.values.astype(float)
+        self.RI  =self.calib.RI  .values.astype(float)
+
+    def coefficients(self,AMAC=None,Channel=None,BG=10,RG=3,OA=5):
+        idx=self.lookup(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG,OA=OA)
+        return self.m[idx],self.b[idx]
+
+    def convert(self,count,AMAC=None,Channel=None,BG=10,RG=3,OA=5):
+        m,b=self.coefficients(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG,OA=OA)
+        return m*count+b
+
+class LookupTable(calibtools.LookupTable):
+    # Current calibration lookup tables, one per OpAmpGain, see
+    # calibtools.LookupTable. The residuals are those of the corrected input
+    # current, on the points kept by the second pass of the fixCalib fit.
+    ARGKEYS=CalibrationTable.ARGKEYS
+
+    def coefficients(self,AMAC=None,Channel=None,BG=10,RG=3,OA=5):
+        idx=self.lookup(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG,OA=OA)
+        return self.m[idx],self.b[idx]
+
+    def residuals(self,data):
+        row=self.rows(data)
+        count=data.ADCvalue.values.astype(int)
+        Voff=self.calib.Voff.values.astype(float)[row]
+        RI  =self.calib.RI  .values.astype(float)[row]
+        CorrectedInputCurrent=_correctedcurrent(data.InputCurrent.values,data.ResistorValue.values+60,Voff,RI)
+        resid=CorrectedInputCurrent-(self.m[row]*count+self.b[row])
+
+        ilimit=(data.OpAmpGain//2).map(ILIMITS).fillna(1).values
+        with np.errstate(divide='ignore',invalid='ignore'):
+            used=(row>=0)&(data.InputCurrent.values<ilimit)&(np.abs(resid/self.m[row])<8)
+        return row[used],count[used],resid[used]
+
+    def convert(self,count,AMAC=None,Channel=None,BG=10,RG=3,OA=5):
+        return self.gather(self.lookup(AMAC=AMAC,Channel=Channel,BG=BG,RG=RG,OA=OA),count)
+
 def convert(count,calib,AMAC=None,BG=10,RG=3,OA=5,Channel=None):
+    if isinstance(calib,(CalibrationTable,LookupTable)):
+        return calib.convert(count,AMAC=AMAC,Channel=Channel,BG=BG,RG=RG,OA=OA)
+
+    if 'status' in calib: calib=calib[calib.status=='ok']
     if AMAC   !=None: calib=calib[calib.AMAC          ==AMAC   ]
     if Channel!=None: calib=calib[calib.Channel       ==Channel]
     if BG     !=None: calib=calib[calib.BandgapControl==BG     ]
@@ -101,7 +270,69 @@ def convert(count,calib,AMAC=None,BG=10,RG=3,OA=5,Channel=None):
 
     return m*count+b
 
+class CalibrationFigure:
+    # Figure template for the calibration of one group, see
+    # calibtools.CalibrationFigure
+    def __init__(self,fig=None):
+        self.fig=fig if fig is not None else Figure()
+
+        gs=self.fig.add_gridspec(3,3,hspace=0.,wspace=0.)
+
+        self.ax=self.fig.add_subplot(gs[0:2,:])
+        self.ax.set_xscale('log')
+        self.data,=self.ax.plot([],[],'.k')
+        self.fit ,=self.ax.plot([],[],'--b')
+        self.ax.set_ylabel('ADC counts')
+        self.ax.set_ylim(0,1024)
+        self.ax.set_xticks([])
+        self.info=self.ax.text(1.5e-4,500,'',multialignment='left')
+
+        self.rax=self.fig.add_subplot(gs[2,:])
+        self.rax.set_xscale('log')
+        self.resid,=self.rax.plot([],[],'.k')
+        self.rax.plot([1e-4,3],[0,0],'--b')
+        self.rax.set_ylim(-10,10)
+        self.rax.set_ylabel('Fit-Data')
+        self.rax.set_xlabel('Corrected Input Current [mA]')
+
+    def draw(self,InputCurrent,ResistorValue,ADCvalue,m,b,Voff,RI,OpAmpGain,title):
+        # Apply corrections
+        CorrectedInputCurrent=(InputCurrent*(ResistorValue+60)-Voff)/((ResistorValue+60)+RI)
+
+        # Get x limit
+        xlim=ILIMITS.get(int(OpAmpGain/2),1)*1e3
+
+        self.data.set_data(CorrectedInputCurrent*1e3,ADCvalue)
+        if m!=None:
+            self.fit  .set_data(CorrectedInputCurrent*1e3,(CorrectedInputCurrent-b)/m)
+            self.resid.set_data(CorrectedInputCurrent*1e3,ADCvalue-(CorrectedInputCurrent-b)/m)
+        else:
+            self.fit  .set_data([],[])
+            self.resid.set_data([],[])
+        self.ax .set_xlim(1e-4,xlim)
+        self.rax.set_xlim(1e-4,xlim)
+        self.ax.set_title(title)
+
+        info=[]
+        info.append('I = m ADC + b')
+        if m!=None:
+            if m<1e-6:
+                info.append('m = %0.2f nA/count'%(m*1e9))
+            else:
+                info.append('m = %0.2f $\mu$A/count'%(m*1e6))
+        if b!=None:
+            if b<1e-3:
+                info.append('b = %0.2f $\mu$A'%(b*1e6))
+            else:
+                info.append('b = %0.2f mA'%(b*1e3))
+        if RI!=None: info.append('R$_{int}$ %0.1f $\Omega$'%(RI))
+        if Voff!=None: info.append('V$_{off}$ %0.1f mV'%(Voff*1e3))
+        self.info.set_text('\n'.join(info))
+
 def plot_calibration(data,calib,AMAC=None,Channel=None,BG=None,RG=None,OA=None):
+    if 'status' in calib:
+        calib=calib[calib.status=='ok']
+
     if AMAC!=None:
         data =data [data .AMAC==AMAC]
         calib=calib[calib.AMAC==AMAC]
@@ -122,68 +353,20 @@ def plot_calibration(data,calib,AMAC=None,Channel=None,BG=None,RG=None,OA=None):
         data =data [(data .OpAmpGain==OA)]
         calib=calib[(calib.OpAmpGain==OA)]
 
-    for amackey,amacgroup in data.groupby('AMAC'):
-        for bgkey,bggroup in amacgroup.groupby('BandgapControl'):
-            for rgkey,rggroup in bggroup.groupby('RampGain'):
-                for oakey,oagroup in rggroup.groupby('OpAmpGain'):
-                    for chkey,chgroup in oagroup.groupby('Channel'):
-                        # Retrieve the calibration
-                        thiscalib=calib[(calib.AMAC==amackey)&(calib.BandgapControl==bgkey)&(calib.RampGain==rgkey)&(calib.OpAmpGain==oakey)&(calib.Channel==chkey)]
-
-                        m=None
-                        b=None
-                        Voff=-0.1
-                        RI=50
-                        if len(thiscalib)>0:
-                            m=thiscalib.m.iloc[0]
-                            b=thiscalib.b.iloc[0]
-
-                            Voff=thiscalib.Voff.iloc[0]
-                            RI=thiscalib.RI.iloc[0]
-
-                        # Apply corrections
-                        CorrectedInputCurrent=(chgroup.InputCurrent*(chgroup.ResistorValue+60)-Voff)/((chgroup.ResistorValue+60)+RI)
-
-                        # Get x limit
-                        xlim=ILIMITS.get(int(oakey/2),1)*1e3
-
-                        # Plot the calibration
-                        plt.subplots_adjust(hspace=0.,wspace=0.)
-
-                        plt.subplot2grid((3,3), (0,0), rowspan=2, colspan=3)
-                        plt.semilogx(CorrectedInputCurrent*1e3,chgroup.ADCvalue,'.k')
-                        if m!=None: plt.semilogx(CorrectedInputCurrent*1e3,(CorrectedInputCurrent-b)/m,'--b')
-                        plt.ylabel('ADC counts')
-                        plt.xlim(1e-4,xlim)
-                        plt.ylim(0,1024)
-                        plt.xticks([])
-                        plt.title('%s, %s, BandgapControl = %d, RampGain = %d, OpAmpGain = %d'%(amackey,chkey,bgkey,rgkey,oakey))
-
-                        info=[]
-                        info.append('I = m ADC + b')
-                        if m!=None:
-                            if m<1e-6:
-                                info.append('m = %0.2f nA/count'%(m*1e9))
-                            else:
-                                info.append('m = %0.2f $\mu$A/count'%(m*1e6))
-                        if b!=None:
-                            if b<1e-3:
-                                info.append('b = %0.2f $\mu$A'%(b*1e6))
-                            else:
-                                info.append('b = %0.2f mA'%(b*1e3))
-                        if RI!=None: info.append('R$_{int}$ %0.1f $\Omega$'%(RI))
-                        if Voff!=None: info.append('V$_{off}$ %0.1f mV'%(Voff*1e3))
-                        plt.text(1.5e-4,500,'\n'.join(info),multialignment='left')
-
-                        plt.subplot2grid((3,3), (2,0), rowspan=1, colspan=3)
-                        if m!=None:
-                            resid=chgroup.ADCvalue-(CorrectedInputCurrent-b)/m
-                            plt.semilogx(CorrectedInputCurrent*1e3,resid,'.k')
-                        plt.semilogx([1e-4,3],[0,0],'--b')
-                        plt.xlim(1e-4,xlim)
-                        plt.ylim(-10,10)
-                        plt.ylabel('Fit-Data')
-                        plt.xlabel('Corrected Input Current [mA]')
-
-                        plt.show()
-    
+    calib=CalibrationTable(calib)
+
+    for (amackey,bgkey,rgkey,oakey,chkey),chgroup in data.groupby(['AMAC','BandgapControl','RampGain','OpAmpGain','Channel']):
+        # Retrieve the calibration
+        m=None
+        b=None
+        Voff=-0.1
+        RI=50
+        if (amackey,chkey,bgkey,rgkey,oakey) in calib.index:
+            idx=calib.index[(amackey,chkey,bgkey,rgkey,oakey)]
+            m,b,Voff,RI=calib.m[idx],calib.b[idx],calib.Voff[idx],calib.RI[idx]
+
+        # Plot the calibration
+        CalibrationFigure(plt.gcf()).draw(chgroup.InputCurrent,chgroup.ResistorValue,chgroup.ADCvalue,m,b,Voff,RI,oakey,
+                                          '%s, %s, BandgapControl = %d, RampGain = %d, OpAmpGain = %d'%(amackey,chkey,bgkey,rgkey,oakey))
+
+        plt.show()
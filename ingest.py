@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import argparse
+import os, os.path
+import shutil
+
+import report
+import pbreport
+
+#
+# Compile the text logs into one parquet dataset per family, partitioned by
+# AMAC (log/) or power board (pblog/). The tables have the same layout as the
+# output of report.read_logs.
+
+def ingest(logdir,outdir,families=report.FAMILIES,key='AMAC',schemas=report.SCHEMAS):
+    logs=report.scan_logs(logdir,families)
+    for family,familylogs in logs.items():
+        data=report.read_logs(family,familylogs,key,families,schemas)
+        if data is None: continue
+
+        path=os.path.join(outdir,family)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+        table=pa.Table.from_pandas(data,preserve_index=False)
+        ds.write_dataset(table,path,format='parquet',partitioning=[key],partitioning_flavor='hive')
+        print('%s: %d files, %d rows'%(family,len(familylogs),len(data)))
+
+class ColumnarBackend:
+    # Reads the tables written by ingest(), only touching the requested
+    # columns and the partitions/row groups matching the filters.
+    def __init__(self,path='data/columnar'):
+        self.path=path
+        self.datasets={}
+
+    def dataset(self,family):
+        if family not in self.datasets:
+            path=os.path.join(self.path,family)
+            self.datasets[family]=ds.dataset(path,format='parquet',partitioning=ds.HivePartitioning.discover(infer_dictionary=True)) if os.path.isdir(path) else None
+        return self.datasets[family]
+
+    def names(self,family):
+        # Partition values (AMAC or PB names) available for a family
+        path=os.path.join(self.path,family)
+        if not os.path.isdir(path): return []
+        return sorted([entry.split('=',1)[1] for entry in os.listdir(path) if '=' in entry])
+
+    def read(self,family,columns=None,**filters):
+        # Filters are column=value or column=[values], None is ignored
+        dataset=self.dataset(family)
+        if dataset is None: return None
+
+        expr=None
+        for column,value in filters.items():
+            if value is None: continue
+            if isinstance(value,(list,tuple,set)):
+                cond=ds.field(column).isin(list(value))
+            else:
+                cond=ds.field(column)==value
+            expr=cond if expr is None else expr&cond
+
+        table=dataset.to_table(columns=columns,filter=expr)
+        if table.num_rows==0: return None
+        return table.to_pandas()
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Compile log/ and pblog/ into columnar tables.')
+    parser.add_argument('--log'   ,default='log'          ,help='AMAC test log directory')
+    parser.add_argument('--pblog' ,default='pblog'        ,help='Power board log directory')
+    parser.add_argument('--output',default='data/columnar',help='Output directory')
+    args=parser.parse_args()
+
+    ingest(args.log  ,args.output,report.FAMILIES  ,'AMAC',report.SCHEMAS  )
+    ingest(args.pblog,args.output,pbreport.FAMILIES,'PB'  ,pbreport.SCHEMAS)
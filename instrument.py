@@ -0,0 +1,139 @@
+import pandas as pd
+
+import contextlib
+import functools
+import json
+import os, os.path
+import time
+import tracemalloc
+
+#
+# Opt-in instrumentation of the analysis stages (log loading, calibration
+# fits, plots). When enabled, every stage appends a JSON line with its wall
+# time, rows processed, bytes read and, optionally, peak memory to a log
+# file. Worker processes inherit the setting through the environment and
+# append to the same file. Disabled (the default), stage() does nothing.
+#
+# Bytes read are the rchar delta of the whole process from /proc, ie: they
+# include every read during the stage (fonts, caches, imports), not only
+# the logs it parses.
+
+ENVVAR='AMAC_INSTRUMENT'
+
+# Open records of the current process, innermost last
+_stack=[]
+
+def enable(path='instrument.jsonl',memory=False):
+    # Start a new instrumentation log, also for child processes. If memory
+    # is set, peak memory is traced with tracemalloc. This slows Python
+    # allocations down several times, so the stage times of such a run are
+    # not representative.
+    path=os.path.abspath(path)
+    open(path,'w').close()
+    os.environ[ENVVAR]=path+(':memory' if memory else '')
+
+def disable():
+    os.environ.pop(ENVVAR,None)
+
+def logpath():
+    # Path of the instrumentation log, None if disabled
+    value=os.environ.get(ENVVAR)
+    if not value: return None
+    return value[:-len(':memory')] if value.endswith(':memory') else value
+
+def _rchar():
+    # Bytes read by this process so far, None where /proc is not available
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+@contextlib.contextmanager
+def stage(stagename,**fields):
+    # Record the enclosed block as a stage. Extra fields are stored with the
+    # record; the block can set record['rows'] on the yielded dict.
+    path=logpath()
+    if path==None:
+        yield {}
+        return
+
+    memory=os.environ[ENVVAR].endswith(':memory')
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    record=dict(stage=stagename,pid=os.getpid(),memory=memory,**fields)
+    if memory:
+        # The parent keeps the peak reached so far before it is reset
+        if len(_stack)>0:
+            _stack[-1]['_peak']=max(_stack[-1]['_peak'],tracemalloc.get_traced_memory()[1])
+        base=tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        record['_peak']=0
+    _stack.append(record)
+
+    rchar=_rchar()
+    start=time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['time']=time.perf_counter()-start
+        if rchar!=None: record['rchar']=_rchar()-rchar
+        _stack.pop()
+
+        if memory:
+            peak=max(record.pop('_peak'),tracemalloc.get_traced_memory()[1])
+            record['peak_mb']=(peak-base)/1e6
+            if len(_stack)>0:
+                _stack[-1]['_peak']=max(_stack[-1]['_peak'],peak)
+
+        with open(path,'a') as fh:
+            fh.write(json.dumps(record,default=str)+'\n')
+
+def timed(name,rows=None):
+    # Decorator recording a method call as a stage. If rows is given, the
+    # length of that attribute of the object is stored as the row count.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self,*args,**kwargs):
+            with stage(name,name=getattr(self,'name',None)) as record:
+                result=method(self,*args,**kwargs)
+                if rows!=None and getattr(self,rows,None) is not None:
+                    record['rows']=len(getattr(self,rows))
+            return result
+        return wrapper
+    return decorator
+
+def read(path=None):
+    # Table of all records in an instrumentation log
+    path=path or logpath()
+    with open(path) as fh:
+        return pd.DataFrame([json.loads(line) for line in fh])
+
+def summary(path=None):
+    # Print and return the totals of each stage
+    records=read(path)
+    if len(records)==0:
+        print('No instrumentation records')
+        return records
+
+    for column in ['rows','rchar','peak_mb']:
+        if column not in records.columns: records[column]=float('nan')
+
+    g=records.groupby('stage',sort=False)
+    table=pd.DataFrame({'calls'   :g.size(),
+                        'time'    :g.time.sum(),
+                        'mean'    :g.time.mean(),
+                        'max'     :g.time.max(),
+                        'rows'    :g.rows.sum(min_count=1),
+                        'MB rchar':g.rchar.sum(min_count=1)/1e6,
+                        'peak MB' :g.peak_mb.max()})
+    table=table.sort_values('time',ascending=False)
+
+    print('Instrumentation summary (%s)'%(path or logpath()))
+    if 'memory' in records.columns and records.memory.fillna(False).astype(bool).any():
+        print('Peak memory was traced, the times include the tracemalloc overhead')
+    print(table.to_string(float_format=lambda x: '%0.3f'%x))
+    return table
@@ -0,0 +1,100 @@
+import pandas as pd
+import numpy as np
+
+import os
+
+#
+# ADC noise from the noise_ADC_V_* logs. Each group of readings at a fixed
+# input is reduced to a histogram of the 1024 codes of the 10-bit ADC, all
+# further statistics are computed from the histograms.
+
+NOISEKEYS=['AMAC','Channel','BandgapControl','RampGain','InputVoltage']
+NCODES=1024
+
+class NoiseHistograms:
+    # Code histograms of each NOISEKEYS group, stored as a table of the group
+    # keys and a (groups, NCODES) array of counts
+    def __init__(self,keys,counts):
+        self.keys=keys.reset_index(drop=True)
+        self.counts=counts
+
+    @classmethod
+    def from_data(cls,data):
+        # Histogram raw noise readings with a single bincount over group and code
+        g=data.groupby(NOISEKEYS)
+        gid=g.ngroup().values
+        keys=g.size().index.to_frame(index=False)
+
+        code=data.ADCvalue.values
+        valid=(gid>=0)&(code>=0)&(code<NCODES)
+        flat=gid[valid]*NCODES+code[valid].astype(int)
+        counts=np.bincount(flat,minlength=len(keys)*NCODES).reshape(len(keys),NCODES)
+        return cls(keys,counts)
+
+    @classmethod
+    def read_csv(cls,path):
+        # Inverse of to_csv
+        data=pd.read_csv(path,float_precision='round_trip')
+        g=data.groupby(NOISEKEYS)
+        gid=g.ngroup().values
+        keys=g.size().index.to_frame(index=False)
+
+        counts=np.zeros((len(keys),NCODES),dtype=int)
+        counts[gid,data.ADCvalue.values]=data['count'].values
+        return cls(keys,counts)
+
+    def to_csv(self,path):
+        # Only the non-empty bins are written, as NOISEKEYS, ADCvalue, count
+        gid,code=np.nonzero(self.counts)
+        data=self.keys.iloc[gid].reset_index(drop=True)
+        data['ADCvalue']=code
+        data['count']=self.counts[gid,code]
+        data.to_csv(path+'.tmp',index=False)
+        os.replace(path+'.tmp',path)
+
+    def select(self,**kwargs):
+        # Subset of the groups matching key=value
+        mask=np.ones(len(self.keys),dtype=bool)
+        for key,value in kwargs.items():
+            mask&=(self.keys[key]==value).values
+        return NoiseHistograms(self.keys[mask],self.counts[mask])
+
+    def sum(self,keys):
+        # Histograms of the groups with the same keys added together
+        g=self.keys.groupby(keys,sort=True,observed=True)
+        counts=np.zeros((g.ngroups,NCODES),dtype=self.counts.dtype)
+        np.add.at(counts,g.ngroup().values,self.counts)
+        return NoiseHistograms(g.size().index.to_frame(index=False),counts)
+
+    def stats(self,quantiles=(0.01,0.5,0.99)):
+        # Entries, mean, RMS, sample standard deviation and quantiles of each
+        # group
+        codes=np.arange(NCODES)
+        n=self.counts.sum(axis=1)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean=self.counts@codes/n
+            ss=(self.counts*(codes[np.newaxis,:]-mean[:,np.newaxis])**2).sum(axis=1)
+            rms=np.sqrt(ss/n)
+            std=np.sqrt(ss/(n-1))
+
+        stats=self.keys.copy()
+        stats['n']=n
+        stats['mean']=mean
+        stats['rms']=rms
+        stats['std']=std
+
+        cdf=np.cumsum(self.counts,axis=1)
+        for q in quantiles:
+            stats['q%g'%(100*q)]=np.argmax(cdf>=q*n[:,np.newaxis],axis=1)
+        return stats
+
+def outliers(stats,column='rms',keys=['Channel','BandgapControl','RampGain'],nmad=5):
+    # Flag groups whose column is more than nmad robust standard deviations
+    # from the median of the fleet with the same keys
+    g=stats.groupby(keys)[column]
+    median=g.transform('median')
+    mad=(stats[column]-median).abs().groupby([stats[key] for key in keys]).transform('median')*1.4826
+
+    stats=stats.copy()
+    stats['outlier']=(stats[column]-median).abs()>nmad*mad
+    return stats
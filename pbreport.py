@@ -2,65 +2,170 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
 import numpy as np
-from scipy.fftpack import fft, ifft
 
 import datetime
 import glob, re
 import os.path
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 from IPython.display import HTML, display
 
 import report
 import calibtools
+import calibcache
+import coiltools
+import instrument
 
 re_amac=re.compile('PB_(AMAC_[A-Z][0-9]+)')
 
+def read_tsv(path,dtype=None):
+    return report.read_typed(path,dtype,sep='\t')
+
+# Power board log families, see report.FAMILIES
+FAMILIES={'General'       :('{PB}_General.log'       ,report.read_table),
+          'VIN'           :('{PB}_VIN.log'           ,report.read_table),
+          'VinIin'        :('{PB}_VinIin.log'        ,read_tsv         ),
+          'DCDCEfficiency':('{PB}_DCDCEfficiency.log',report.read_table),
+          'Ileak'         :('{PB}_Ileak.log'         ,report.read_table),
+          'Bandgap'       :('{PB}_Bandgap.log'       ,report.read_table),
+          'CoilLVON'      :('{PB}_CoilLVON.log'      ,report.read_table),
+          'CoilLVOFF'     :('{PB}_CoilLVOFF.log'     ,report.read_table)}
+
+# Column types of each family, see report.SCHEMAS
+KEYS ={'PB':'category'}
+COIL =dict(KEYS,time='float64',coil='float64')
+SCHEMAS={'General'       :dict(KEYS,OTALEFT='uint16',OTARIGHT='uint16',DVDD2='uint16',BGO='uint16',InBase='float64'),
+         'VIN'           :dict(KEYS,Vin='float64',VinADC='uint16'),
+         'VinIin'        :dict(KEYS,Vin='float64',Iin='float64',Vout='float64'),
+         'DCDCEfficiency':dict(KEYS,Iout='float64',Vout='float64',Iin='float64',Vin='float64',IoutADC='uint16',ntc='uint16',ptat='uint16'),
+         'Ileak'         :dict(KEYS,Ileak='float64',OpAmpGain0='uint16',OpAmpGain1='uint16',OpAmpGain2='uint16',OpAmpGain4='uint16',OpAmpGain8='uint16'),
+         'Bandgap'       :dict(KEYS,BandgapControl='uint8',Voltage='float64'),
+         'CoilLVON'      :COIL,
+         'CoilLVOFF'     :COIL}
+
 class CoilMeasurement:
-    def __init__(self,path):
+    # Single coil trace, with its spectrum computed on first use. Use
+    # coiltools.CoilSpectra to analyse many boards at once.
+    def __init__(self,path,volt=None,window=None):
         self.path=path
+        self.window=window
 
-        self.volt=pd.read_csv(path,sep=' ')
-
-        self.fft=None
-        T=self.volt.time.iloc[1]
-        N=len(self.volt.index)        
-        yf = 2.0/N * np.abs(fft(self.volt.coil)[0:N//2])
-        xf = np.linspace(0.0, 1.0/(2.0*T), N//2)*1e-6
-        self.fft=pd.DataFrame(data={'freq':xf,'ampl':yf})
+        self.volt=volt if volt is not None else pd.read_csv(path,sep=' ')
 
+    def load_fft(self):
+        dt,traces=coiltools.stack_traces([self.volt])
+        freq,ampl=coiltools.spectrum(traces,dt,self.window)
+        self.fft=pd.DataFrame(data={'freq':freq,'ampl':ampl[0]})
 
+    fft=report.Section(load_fft)
 
-class Reports:
-    def __init__(self,reports):
-        self.names   =[r.name for r in reports]
 
-        self.vin   =pd.concat([r.vin    for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.viniin=pd.concat([r.viniin for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.dcdceff=pd.concat([r.dcdceff for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.ileak=pd.concat([r.ileak for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.bgo=pd.concat([r.bgo for r in reports], ignore_index=True) if len(reports)>0 else None
+class Reports(report.ReportCollection):
+    SECTIONS=['vin','viniin','dcdceff','ileak','bgo']
 
-    def append(self,r):
-        self.names.append(r.name)
+    vin    =report.Section(lambda self: self._concat('vin'    ))
+    viniin =report.Section(lambda self: self._concat('viniin' ))
+    dcdceff=report.Section(lambda self: self._concat('dcdceff'))
+    ileak  =report.Section(lambda self: self._concat('ileak'  ))
+    bgo    =report.Section(lambda self: self._concat('bgo'    ))
 
-        self.vin=pd.concat([r.vin, self.vin], ignore_index=True) if self.vin is not None else r.vin
-        self.dcdceff=pd.concat([r.dcdceff, self.dcdceff], ignore_index=True) if self.dcdceff is not None else r.dcdceff
-        self.ileak=pd.concat([r.ileak, self.ileak], ignore_index=True) if self.ileak is not None else r.ileak
-        self.bgo=pd.concat([r.bgo, self.bgo], ignore_index=True) if self.bgo is not None else r.bgo
+    def __init__(self,reports):
+        report.ReportCollection.__init__(self,reports)
+        self.failures={}
+        self.calib=None
 
+    @classmethod
+    def load_all(cls,logdir='pblog',jobs=1,match='PB_AMAC_???',family=None,sections=None,calib=None,cache=None):
+        # Load all boards in logdir whose name matches the match pattern (and
+        # that have a log of the given family) from a single directory scan,
+        # jobs at a time. The AMAC calibrations of all boards are resolved once
+        # by calibrations(), unless a calib table is given, and each board
+        # takes its rows of that table. Only the listed sections are loaded,
+        # see Report.SECTIONS. Boards that fail to load are listed in failures.
+        index=report.index_logs(report.scan_logs(logdir,FAMILIES))
+        names=report.match_names(index,match,family)
+
+        if calib is None:
+            AMACs=sorted(set([m.group(1) for m in map(re_amac.match,names) if m!=None]))
+            with instrument.stage('pbreport.calibrations',rows=len(AMACs)):
+                calib=calibrations(AMACs,cache,jobs)
+
+        tasks=[]
+        for name in names:
+            amac_match=re_amac.match(name)
+            tasks.append((name,logdir,sections,calib[calib.AMAC==amac_match.group(1)] if amac_match!=None else None))
+        if jobs>1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results=list(executor.map(_load_board,tasks))
+        else:
+            results=[_load_board(task) for task in tasks]
+
+        reports=[]
+        failures={}
+        for name,(r,error) in zip(names,results):
+            if r is None:
+                print('WARNING: Failed to load %s: %s'%(name,error))
+                failures[name]=error
+                continue
+            reports.append(r)
+
+        reports=cls(reports)
+        reports.failures=failures
+        reports.calib=calib
+        return reports
+
+
+def calibrations(AMACs,cache=None,jobs=1):
+    # Voltage calibrations of all AMACs as a single table. Cached calibrations
+    # are used as they are, the others are fitted in one pass over the AMAC
+    # logs, loaded jobs at a time, and stored in the cache.
+    cache=cache or calibcache.CalibCache()
+    calibs={AMAC:cache.load(AMAC,'calib') for AMAC in AMACs}
+
+    missing=[AMAC for AMAC,calib in calibs.items() if calib is None]
+    if len(missing)>0:
+        index=report.index_logs(report.scan_logs(cache.logdir))
+        names=[AMAC for AMAC in missing if calibcache.INPUTS['calib'] in index.get(AMAC,{})]
+        reports=report.Reports.from_index(index,names,cache.logdir,jobs=jobs,sections=['calib'])
+        if len(reports.names)>0:
+            for AMAC,calib in calibtools.calibrate(reports.calib).groupby('AMAC',observed=True):
+                calib=calib.astype({'AMAC':str,'Channel':str})
+                cache.store(AMAC,calib,'calib')
+                calibs[AMAC]=calib
+
+    calibs=[calib for calib in calibs.values() if calib is not None]
+    if len(calibs)==0:
+        return pd.DataFrame(columns=calibtools.CALIBKEYS+['m','b'])
+    return pd.concat(calibs,ignore_index=True)
+
+def _load_board(task):
+    name,logdir,sections,calib=task
+    try:
+        return Report(name,logdir,sections=sections,calib=calib),None
+    except Exception as e:
+        return None,''.join(traceback.format_exception_only(type(e),e)).strip()
 
 class Report:
-    def __init__(self,name):
+    # Board sections, loaded when the report is created. The General log is
+    # always read, it has the settings that the other sections depend on.
+    SECTIONS=['vin','viniin','dcdceff','ileak','coil']
+
+    def __init__(self,name,logdir='pblog',backend=None,sections=None,calib=None,cache=None):
         self.name=name
+        self.logdir=logdir
+        self.backend=backend
 
-        self.amac=None
+        self.amacname=None
+        self._amac=None
         self.calib=None
+        self.calibtable=None
 
         self.general=None
         self.otaleft=None
         self.otaright=None
         self.dvdd2=None
-        self.bgo=None
+        self.bgocode=None
         self.Ibase=None
 
         self.vin=None
@@ -71,58 +176,82 @@ class Report:
         self.coil_lvon =None
         self.coil_lvoff=None
 
-        self.load_calib()
+        self.load_calib(calib,cache)
 
         self.load_general()
-        self.load_vin()
-        self.load_viniin()
-        self.load_dcdceff()
-        self.load_ileak()
-        #self.load_bgo()
-        self.load_coil()
-
+        for section in (self.SECTIONS if sections==None else sections):
+            getattr(self,'load_%s'%section)()
+
+    def _read(self,family):
+        # Table of the log of a family for this board, None if missing
+        if self.backend is not None:
+            return self.backend.read(family,PB=self.name)
+        datapath=os.path.join(self.logdir,FAMILIES[family][0].format(PB=self.name))
+        if not os.path.exists(datapath):
+            return None
+        return report.read_logs(family,[(self.name,None,datapath)],'PB',FAMILIES,SCHEMAS)
+
+    @instrument.timed('pbreport.Report.general',rows='general')
     def load_general(self):
         #OTALEFT OTARIGHT DVDD2 BGO InBase
 
-        datapath='pblog/{PB}_General.log'.format(PB=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['PB']=self.name
-
+        data=self._read('General')
+        if data is not None:
             self.otaleft =data.OTALEFT.iloc[0]
             self.otaright=data.OTARIGHT.iloc[0]
             self.dvdd2   =data.DVDD2.iloc[0]
-            self.bgo     =int(data.BGO.iloc[0])
+            self.bgocode =int(data.BGO.iloc[0])
             self.Ibase   =data.InBase.iloc[0]
+        else:
+            data=report.empty(SCHEMAS['General'])
 
         self.general=data
 
     def render_general(self):
+        if len(self.general)==0:
+            print('No General log for %s'%self.name)
+            return
+
         rows=['<td><b>OTA left</b></td><td>{}</td>'.format(self.otaleft),
               '<td><b>OTA right</b></td><td>{}</td>'.format(self.otaright),
               '<td><b>DVD/2</b></td><td>{}</td>'.format(self.dvdd2),
-              '<td><b>BGO</b></td><td>{}</td>'.format(self.bgo),
+              '<td><b>BGO</b></td><td>{}</td>'.format(self.bgocode),
               '<td><b>Ibase</b></td><td>{}</td>'.format(self.Ibase)]
         html='<html><body><table><tr><th></th><th>AMAC [counts]</th></tr>%s</table></body></html>'%(''.join(['<tr>{}</tr>'.format(row) for row in rows]))
         display(HTML(html))
 
-    def load_calib(self):
+    @property
+    def amac(self):
+        # Full AMAC test report, only parsed when needed
+        if self._amac is None and self.amacname!=None:
+            self._amac=report.Report(self.amacname,backend=self.backend)
+        return self._amac
+
+    @instrument.timed('pbreport.Report.calib',rows='calib')
+    def load_calib(self,calib=None,cache=None):
+        # Calibration of the AMAC, from a table of precomputed calibrations if
+        # one is given, otherwise from a calibcache.CalibCache (by default the
+        # one in data/calib)
         amac_match=re_amac.match(self.name)
         if amac_match!=None:
-            self.amac=report.Report(amac_match.group(1))
-            self.calib=calibtools.calibrate(self.amac.calib)
-
+            self.amacname=amac_match.group(1)
+            if calib is not None:
+                self.calib=calib[calib.AMAC==self.amacname].reset_index(drop=True)
+            else:
+                cache=cache or calibcache.CalibCache()
+                self.calib=cache.get(self.amacname,'calib',lambda AMAC,kind: calibtools.calibrate(self.amac.calib))
+            self.calibtable=calibtools.CalibrationTable(self.calib)
+
+    @instrument.timed('pbreport.Report.vin',rows='vin')
     def load_vin(self):
-        datapath='pblog/{PB}_VIN.log'.format(PB=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['PB']=self.name
+        data=self._read('VIN')
+        if data is not None:
             R1=90.9
             R2=10
             g=(R1+R2)/R2
-            data['VinCalib']=data.apply(lambda row: calibtools.convert(row.VinADC,self.calib,Channel='CH0_R',BG=10,RG=3)*g, axis=1)
+            data['VinCalib']=self.calibtable.convert(data.VinADC,Channel='CH0_R',BG=10,RG=3)*g
+        else:
+            data=report.empty(SCHEMAS['VIN'])
         self.vin=data
 
     def render_vin(self):
@@ -146,6 +275,7 @@ class Report:
         plt.ylabel('(AMAC-PS)/PS')
         plt.xlabel('Input Voltage [V]')
 
+    @instrument.timed('pbreport.Report.dcdceff',rows='dcdceff')
     def load_dcdceff(self):
         #Rf=499e3
         #Rg=200e3
@@ -154,18 +284,16 @@ class Report:
         shunt=0.008
         G=Rf/Rg
 
-        datapath='pblog/{PB}_DCDCEfficiency.log'.format(PB=self.name)
-        data=pd.DataFrame()
-
         Ibase=self.Ibase if self.Ibase!=None else 0.4
 
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['PB']=self.name
-            data['IoutCalib']=data.apply(lambda row: calibtools.convert(row.IoutADC,self.calib,Channel='CH1_R',BG=10,RG=3), axis=1)
+        data=self._read('DCDCEfficiency')
+        if data is not None:
+            data['IoutCalib']=self.calibtable.convert(data.IoutADC,Channel='CH1_R',BG=10,RG=3)
             data['IoutAMAC']=data['IoutCalib']/G/0.008*1000
             #data['eff']=(data.Iout/1000)*(data.Vout/1000)/(data.Iin-Ibase)/(data.Vin*10)
             data['eff']=(data.Iout/1000)*(1.5)/(data.Iin-Ibase)/(11)
+        else:
+            data=report.empty(SCHEMAS['DCDCEfficiency'])
 
         self.dcdceff=data
 
@@ -201,12 +329,11 @@ class Report:
         plt.ylabel('(AMAC-PS)/PS')
         plt.xlabel('Output Current [mA]')
 
+    @instrument.timed('pbreport.Report.ileak',rows='ileak')
     def load_ileak(self):
-        datapath='pblog/{PB}_Ileak.log'.format(PB=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['PB']=self.name
+        data=self._read('Ileak')
+        if data is None:
+            data=report.empty(SCHEMAS['Ileak'])
         self.ileak=data
 
     def render_ileak(self):
@@ -220,12 +347,11 @@ class Report:
         plt.title(self.name)
         plt.legend(frameon=False)
 
+    @instrument.timed('pbreport.Report.bgo',rows='bgo')
     def load_bgo(self):
-        datapath='pblog/{PB}_Bandgap.log'.format(PB=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['PB']=self.name
+        data=self._read('Bandgap')
+        if data is None:
+            data=report.empty(SCHEMAS['Bandgap'])
         self.bgo=data
 
     def render_bgo(self):
@@ -234,12 +360,11 @@ class Report:
         plt.ylabel('Bandgap Voltage [V]')
         plt.title(self.name)
 
+    @instrument.timed('pbreport.Report.viniin',rows='viniin')
     def load_viniin(self):
-        datapath='pblog/{PB}_VinIin.log'.format(PB=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep='\t')
-            data['PB']=self.name
+        data=self._read('VinIin')
+        if data is None:
+            data=report.empty(SCHEMAS['VinIin'])
         self.viniin=data
 
     def render_viniin(self):
@@ -249,14 +374,15 @@ class Report:
         plt.ylabel('Input Current [A]')
         plt.xlabel('Input Voltage [V]')
 
+    @instrument.timed('pbreport.Report.coil')
     def load_coil(self):
-        datapath='pblog/{PB}_CoilLVON.log'.format(PB=self.name)
-        if os.path.exists(datapath):
-            self.coil_lvon=CoilMeasurement(datapath)
+        data=self._read('CoilLVON')
+        if data is not None:
+            self.coil_lvon=CoilMeasurement(os.path.join(self.logdir,FAMILIES['CoilLVON'][0].format(PB=self.name)),data)
 
-        datapath='pblog/{PB}_CoilLVOFF.log'.format(PB=self.name)
-        if os.path.exists(datapath):
-            self.coil_lvoff=CoilMeasurement(datapath)
+        data=self._read('CoilLVOFF')
+        if data is not None:
+            self.coil_lvoff=CoilMeasurement(os.path.join(self.logdir,FAMILIES['CoilLVOFF'][0].format(PB=self.name)),data)
     
     def render_coil(self):
         plt.plot(self.coil_lvon.volt.time*1e9 ,self.coil_lvon.volt.coil)
@@ -0,0 +1,97 @@
+import numpy as np
+
+import hashlib
+import json
+import os, os.path
+from concurrent.futures import ProcessPoolExecutor
+
+import calibtools
+import icalibtools
+import instrument
+
+#
+# Batch rendering of the calibration plots of every group to PNG files. Each
+# worker draws into a single reused figure template, so no pyplot state is
+# involved. Images are skipped if their inputs did not change since they were
+# last rendered, as recorded in a render_<kind>.json manifest in imgdir.
+
+# Image file name of each group
+IMAGES={'calib' :'calib_%s_%s_BandgapControl%d_RampGain%d.png',
+        'icalib':'icalib_%s_%s_BandgapControl%d_RampGain%d_OpAmpGain%d.png'}
+
+def _tasks(data,calib,kind):
+    # List of (image, draw arguments) for each group in data
+    tasks=[]
+    if kind=='calib':
+        table=calibtools.CalibrationTable(calib)
+        for (amackey,chkey,bgkey,rgkey),group in data.groupby(calibtools.CALIBKEYS):
+            m,b=None,None
+            if (amackey,chkey,bgkey,rgkey) in table.index:
+                m,b=table.coefficients(amackey,chkey,bgkey,rgkey)
+            tasks.append((IMAGES[kind]%(amackey,chkey,bgkey,rgkey),
+                          (group.InputVoltage.values,group.ADCvalue.values,m,b,
+                           '%s, %s, RampGain = %d, BandgapControl = %d'%(amackey,chkey,rgkey,bgkey))))
+    else:
+        table=icalibtools.CalibrationTable(calib)
+        for (amackey,chkey,bgkey,rgkey,oakey),group in data.groupby(icalibtools.CALIBKEYS):
+            m,b,Voff,RI=None,None,-0.1,50
+            if (amackey,chkey,bgkey,rgkey,oakey) in table.index:
+                idx=table.index[(amackey,chkey,bgkey,rgkey,oakey)]
+                m,b,Voff,RI=table.m[idx],table.b[idx],table.Voff[idx],table.RI[idx]
+            tasks.append((IMAGES[kind]%(amackey,chkey,bgkey,rgkey,oakey),
+                          (group.InputCurrent.values,group.ResistorValue.values,group.ADCvalue.values,m,b,Voff,RI,oakey,
+                           '%s, %s, BandgapControl = %d, RampGain = %d, OpAmpGain = %d'%(amackey,chkey,bgkey,rgkey,oakey))))
+    return tasks
+
+def _digest(args):
+    h=hashlib.sha1()
+    for arg in args:
+        if isinstance(arg,np.ndarray):
+            h.update(np.ascontiguousarray(arg,dtype=float).tobytes())
+        else:
+            h.update(repr(arg).encode())
+    return h.hexdigest()
+
+def _render(job):
+    kind,imgdir,tasks=job
+    template=calibtools.CalibrationFigure() if kind=='calib' else icalibtools.CalibrationFigure()
+    for image,args in tasks:
+        with instrument.stage('plotbatch.render',image=image,rows=len(args[0])):
+            template.draw(*args)
+            template.fig.savefig(os.path.join(imgdir,image))
+    template.fig.clear()
+    return [image for image,args in tasks]
+
+def render(data,calib,kind='calib',imgdir='img',jobs=1,force=False):
+    # Render the calibration plots of all groups in data, returning the list
+    # of images that were (re)drawn
+    os.makedirs(imgdir,exist_ok=True)
+    manifestpath=os.path.join(imgdir,'render_%s.json'%kind)
+    manifest={}
+    if os.path.exists(manifestpath):
+        with open(manifestpath) as fh:
+            manifest=json.load(fh)
+
+    tasks=[]
+    digests={}
+    for image,args in _tasks(data,calib,kind):
+        digests[image]=_digest(args)
+        if not force and manifest.get(image)==digests[image] and os.path.exists(os.path.join(imgdir,image)):
+            continue
+        tasks.append((image,args))
+
+    nchunks=min(len(tasks),4*jobs)
+    chunks=[(kind,imgdir,tasks[i::nchunks]) for i in range(nchunks)]
+    if jobs>1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            rendered=sum(executor.map(_render,chunks),[])
+    else:
+        rendered=sum(map(_render,chunks),[])
+
+    for image in rendered:
+        manifest[image]=digests[image]
+    with open(manifestpath+'.tmp','w') as fh:
+        json.dump(manifest,fh,indent=1,sort_keys=True)
+    os.replace(manifestpath+'.tmp',manifestpath)
+
+    return rendered
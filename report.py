@@ -1,176 +1,500 @@
-import datetime
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
 import glob, re
 import os.path
+import fnmatch
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 from IPython.display import HTML, display
 
-class Reports:
+import instrument
+import noisetools
+
+def read_typed(path,dtype=None,**kwargs):
+    # pd.read_csv of a log with the types of a schema. The integer columns are
+    # parsed as they come and cast by typed(), so that a blank or out of range
+    # value only drops its row and not the whole log.
+    data=pd.read_csv(path,dtype=parsetypes(dtype),**kwargs)
+    nrows=len(data)
+    data=typed(data,dtype)
+    if len(data)<nrows:
+        print('WARNING: Dropped %d invalid rows of %s'%(nrows-len(data),path))
+    return data
+
+def read_table(path,dtype=None):
+    return read_typed(path,dtype,sep=' ')
+
+def read_lines(path):
+    return pd.read_csv(path, header=None, names=['raw'])
+
+def parse_errors(raw):
+    # Vectorized parse of '<ctime> [AMAC] (SW) Error <code>' lines. The ctime
+    # timestamp is fixed width and the code is always the last field.
+    raw=raw.str.rstrip()
+    return pd.DataFrame({'date':pd.to_datetime(raw.str.slice(4,24),format='%b %d %H:%M:%S %Y'),
+                         'code':raw.str.rsplit(' ',n=1).str[1].astype(int)})
+
+def read_errors(path,dtype=None):
+    return typed(parse_errors(read_lines(path).raw),dtype)
+
+def count_errors(path,freq='1h',chunksize=100000):
+    # Number of errors of each code per freq time bucket, streamed through the
+    # file chunksize lines at a time without keeping the lines around
+    counts=[]
+    for chunk in pd.read_csv(path, header=None, names=['raw'], chunksize=chunksize):
+        errors=parse_errors(chunk.raw)
+        counts.append(errors.groupby([errors.date.dt.floor(freq),'code']).size())
+    return _sum_counts(counts)
+
+def _sum_counts(counts):
+    if len(counts)==0:
+        return pd.DataFrame(columns=['date','code','count'])
+    counts=pd.concat(counts).groupby(level=[0,1]).sum()
+    return counts.rename('count').reset_index()
+
+def read_keyvalues(paths,dtype=None):
+    # Lines of 'Key: v0 v1 ...' of many files parsed in one pass, as a long
+    # table of Key, Index (position of the value on its line, ie: the
+    # threshold of the ILOCK ADC_channel_settings) and Value. Also returns
+    # the number of rows of each file.
+    lines=[]
+    nlines=[]
+    for path in paths:
+        with open(path) as fh:
+            filelines=[line for line in fh.read().splitlines() if line.strip()!='']
+        lines+=filelines
+        nlines.append(len(filelines))
+    if len(lines)==0:
+        return typed(pd.DataFrame({'Key':[],'Index':[],'Value':[]}),dtype),np.zeros(len(nlines),dtype=int)
+
+    keyvalues=pd.Series(lines,dtype=object).str.partition(':')
+    values=keyvalues[2].str.split()
+    counts=values.str.len().values.astype(int)
+    values=values.explode().dropna()
+
+    starts=np.repeat(np.cumsum(counts)-counts,counts)
+    data=pd.DataFrame({'Key'  :np.repeat(keyvalues[0].values,counts),
+                       'Index':np.arange(len(values))-starts,
+                       'Value':values.values.astype(np.int64)})
+    lengths=np.bincount(np.repeat(np.repeat(np.arange(len(nlines)),nlines),counts),minlength=len(nlines))
+    return typed(data,dtype),lengths
+
+def read_keyvalue(path,dtype=None):
+    return read_keyvalues([path],dtype)[0]
+
+# Readers of many files at once, returning the table and the rows per file
+BULKREADERS={read_keyvalue:read_keyvalues}
+
+def isinteger(dtype):
+    return pd.api.types.is_integer_dtype(pd.api.types.pandas_dtype(dtype))
+
+def parsetypes(schema):
+    # Types of a schema that pd.read_csv can apply to any row
+    if schema==None: return None
+    return {column:dtype for column,dtype in schema.items() if not isinteger(dtype)}
+
+def typed(data,schema=None):
+    # Cast the columns of data that appear in a schema. Rows with a missing,
+    # fractional or out of range value in an integer column are dropped.
+    if schema==None: return data
+    schema={column:dtype for column,dtype in schema.items() if column in data.columns}
+
+    valid=np.ones(len(data),dtype=bool)
+    for column,dtype in schema.items():
+        if not isinteger(dtype) or data[column].dtype==dtype: continue
+        values=pd.to_numeric(data[column],errors='coerce').values.astype(float)
+        info=np.iinfo(dtype)
+        valid&=(values>=info.min)&(values<=info.max)&(values==np.floor(values))
+    if not valid.all():
+        data=data[valid].reset_index(drop=True)
+    return data.astype(schema)
+
+def empty(schema):
+    # Empty table with the columns and types of a schema
+    return pd.DataFrame({column:pd.Series(dtype=dtype) for column,dtype in schema.items()})
+
+# Test log families, as (file pattern, reader). A * in the pattern is the
+# channel, which is stored in the Channel column.
+FAMILIES={'GeneralParams':('{AMAC}_GeneralParams.log'  ,read_table   ),
+          'I2C'          :('{AMAC}_I2C_main.log'       ,read_table   ),
+          'BG'           :('{AMAC}_BG_*.log'           ,read_table   ),
+          'noise'        :('{AMAC}_noise_ADC_V_*.log'  ,read_table   ),
+          'calib_ADC_V'  :('{AMAC}_calib_ADC_V_*.log'  ,read_table   ),
+          'calib_ADC_I'  :('{AMAC}_calib_ADC_I_*.log'  ,read_table   ),
+          'CLK'          :('{AMAC}_CLK_main.log'       ,read_keyvalue),
+          'ILOCK_DAC'    :('{AMAC}_ILOCK_DAC_*.log'    ,read_keyvalue),
+          'ILOCK_noDAC'  :('{AMAC}_ILOCK_noDAC_*.log'  ,read_keyvalue),
+          'LVCTRL'       :('{AMAC}_LVCTRL_main.log'    ,read_keyvalue),
+          'Errors'       :('{AMAC}_Errors.log'         ,read_errors  )}
+
+# Column types of each family, applied as the logs are parsed. The AMAC and
+# Channel keys are categorical and added by read_logs. ADC codes fit in 10
+# bits and the chip settings in a few.
+KEYS  ={'AMAC':'category','Channel':'category'}
+ADC_V =dict(KEYS,InputVoltage='float64',BandgapControl='uint8',RampGain='uint8',ADCvalue='uint16')
+ADC_I =dict(KEYS,InputCurrent='float64',BandgapControl='uint8',RampGain='uint8',OpAmpGain='uint8',ResistorIdx='uint8',ADCvalue='uint16')
+KEYVALUE=dict(KEYS,Key='category',Index='uint8',Value='int64')
+SCHEMAS={'GeneralParams':dict(KEYS,Param=object,val='float64',stddev='float64'),
+         'I2C'          :dict(KEYS,VCC_H='float64',I2C_SuccessRate='float64'),
+         'BG'           :dict(KEYS,BGreg_val='uint8',Voltage='float64',mean='float64',stddev='float64'),
+         'noise'        :ADC_V,
+         'calib_ADC_V'  :ADC_V,
+         'calib_ADC_I'  :ADC_I,
+         'CLK'          :KEYVALUE,
+         'ILOCK_DAC'    :KEYVALUE,
+         'ILOCK_noDAC'  :KEYVALUE,
+         'LVCTRL'       :KEYVALUE,
+         'Errors'       :dict(KEYS,date='datetime64[ns]',code='uint16')}
+
+# Load resistor [Ohm] of each ResistorIdx of the current calibration
+RESISTORS=np.array([0,100,10e3,1e6])
+
+# Columns of Report.clk, and the CLK log key of each
+CLKCOLUMNS={'Internal'     :'Internal_Oscillator',
+            'External_Div0':'External_Oscillator_10M_HVenabled_div0_HVCTRL',
+            'External_Div1':'External_Oscillator_10M_HVenabled_div1_HVCTRL',
+            'External_Div2':'External_Oscillator_10M_HVenabled_div2_HVCTRL',
+            'External_Div3':'External_Oscillator_10M_HVenabled_div3_HVCTRL'}
+
+def logregex(pattern):
+    # Regex matching a family file name, with the name and channel as groups
+    key=re.search('{(.*)}',pattern).group(1)
+    regex=re.escape(pattern).replace(re.escape('{%s}'%key),'(?P<name>.+?)').replace(re.escape('*'),'(?P<Channel>.*)')
+    return re.compile('^%s$'%regex)
+
+def scan_logs(logdir='log',families=FAMILIES):
+    # Sort all files in logdir by family, returning {family: [(name, channel, path)]}
+    regexes=[(family,logregex(pattern)) for family,(pattern,reader) in families.items()]
+
+    logs={family:[] for family in families}
+    for filename in sorted(os.listdir(logdir)):
+        for family,regex in regexes:
+            match=regex.match(filename)
+            if match==None: continue
+            logs[family].append((match.group('name'),match.groupdict().get('Channel'),os.path.join(logdir,filename)))
+            break
+    return logs
+
+def index_logs(logs):
+    # Regroup the output of scan_logs as {name: {family: [(name, channel, path)]}}
+    index={}
+    for family,familylogs in logs.items():
+        for log in familylogs:
+            index.setdefault(log[0],{}).setdefault(family,[]).append(log)
+    return index
+
+def match_names(index,match='*',family=None):
+    # Names in an index_logs() index matching a pattern and with a given family
+    return sorted([name for name in index if fnmatch.fnmatch(name,match) and (family==None or family in index[name])])
+
+def read_logs(family,logs,key='AMAC',families=FAMILIES,schemas=SCHEMAS):
+    # Read a list of (name, channel, path) of one family into a single table
+    if len(logs)==0: return None
+    reader=families[family][1]
+    if reader in BULKREADERS:
+        data,lengths=BULKREADERS[reader]([path for name,channel,path in logs],dtype=schemas.get(family))
+    else:
+        frames=[reader(path,dtype=schemas.get(family)) for name,channel,path in logs]
+        lengths=[len(a) for a in frames]
+        data=pd.concat(frames,ignore_index=True)
+    data[key]=repeat_categorical([log[0] for log in logs],lengths)
+    if logs[0][1]!=None: data['Channel']=repeat_categorical([log[1] for log in logs],lengths)
+    return data
+
+def repeat_categorical(values,counts):
+    # Categorical with each value repeated counts times
+    values=pd.Categorical(values)
+    return pd.Categorical.from_codes(np.repeat(values.codes,counts),values.categories)
+
+def concat(frames):
+    # pd.concat of tables keeping the categorical columns categorical, over
+    # the union of their categories. Empty tables are skipped.
+    frames=[frame for frame in frames if len(frame)>0] or frames[:1]
+    columns={column for frame in frames for column,dtype in frame.dtypes.items() if isinstance(dtype,pd.CategoricalDtype)}
+    for column in columns:
+        dtype=pd.CategoricalDtype(sorted(set().union(*[frame[column].cat.categories for frame in frames if column in frame.columns])))
+        frames=[frame.astype({column:dtype}) if column in frame.columns else frame for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+class Section:
+    # Attribute computed by loader(obj) on first access and then cached
+    def __init__(self,loader):
+        self.loader=loader
+
+    def __set_name__(self,owner,name):
+        self.name=name
+
+    def __get__(self,obj,objtype=None):
+        if obj is None: return self
+        if self.name not in obj.__dict__:
+            with instrument.stage('%s.%s.%s'%(type(obj).__module__,type(obj).__name__,self.name),name=getattr(obj,'name',None)) as record:
+                self.loader(obj)
+                if hasattr(obj.__dict__.get(self.name),'__len__'):
+                    record['rows']=len(obj.__dict__[self.name])
+        return obj.__dict__[self.name]
+
+    def __set__(self,obj,value):
+        obj.__dict__[self.name]=value
+
+    def __delete__(self,obj):
+        obj.__dict__.pop(self.name,None)
+
+class ReportCollection:
+    # Collection of per-chip reports. Each section is held as per-chip chunks
+    # that are concatenated once, when the section is first accessed, along
+    # with the row range of every chip in the combined table.
+    SECTIONS=[]
+
     def __init__(self,reports):
-        self.names   =[r.name for r in reports]
+        self.reports =list(reports)
+        self.names   =[r.name for r in self.reports]
+        self.offsets ={}
+
+    def _concat(self,section):
+        chunks=[getattr(r,section) for r in self.reports]
+        if len(chunks)==0:
+            setattr(self,section,None)
+            return
 
-        self.genparam=pd.concat([r.genparam for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.i2c     =pd.concat([r.i2c      for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.bgo     =pd.concat([r.bgo      for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.noise   =pd.concat([r.noise    for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.calib   =pd.concat([r.calib    for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.icalib  =pd.concat([r.icalib   for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.clk     =pd.concat([r.clk      for r in reports], ignore_index=True) if len(reports)>0 else None
-        self.error   =pd.concat([r.error    for r in reports], ignore_index=True) if len(reports)>0 else None
+        missing=[r.name for r,chunk in zip(self.reports,chunks) if chunk is None]
+        if len(missing)>0:
+            raise ValueError('Section %s was not loaded for %s'%(section,', '.join(missing)))
+
+        stops=np.cumsum([len(chunk) for chunk in chunks])
+        self.offsets[section]={r.name:slice(stop-len(chunk),stop) for r,chunk,stop in zip(self.reports,chunks,stops)}
+        setattr(self,section,concat(chunks))
+
+    def select(self,section,name):
+        # Rows of one chip in a section, as a slice of the combined table
+        data=getattr(self,section)
+        return data.iloc[self.offsets[section][name]]
 
     def append(self,r):
+        self.reports.append(r)
         self.names.append(r.name)
 
-        self.genparam=pd.concat([r.genparam, self.genparam], ignore_index=True) if self.genparam is not None else r.genparam
-        self.i2c     =pd.concat([r.i2c     , self.i2c     ], ignore_index=True) if self.i2c      is not None else r.i2c
-        self.bgo     =pd.concat([r.bgo     , self.bgo     ], ignore_index=True) if self.bgo      is not None else r.bgo
-        self.noise   =pd.concat([r.noise   , self.noise   ], ignore_index=True) if self.noise    is not None else r.noise
-        self.calib   =pd.concat([r.calib   , self.calib   ], ignore_index=True) if self.calib    is not None else r.calib
-        self.icalib  =pd.concat([r.icalib  , self.icalib  ], ignore_index=True) if self.icalib   is not None else r.icalib
-        self.clk     =pd.concat([r.clk     , self.clk     ], ignore_index=True) if self.clk      is not None else r.clk
-        self.error   =pd.concat([r.error   , self.error   ], ignore_index=True) if self.error    is not None else r.error
+        for section in self.SECTIONS:
+            delattr(self,section)
+            self.offsets.pop(section,None)
+
+class Reports(ReportCollection):
+    SECTIONS=['genparam','i2c','bgo','noise','calib','icalib','clk','ilock','lvctrl','error']
 
+    genparam=Section(lambda self: self._concat('genparam'))
+    i2c     =Section(lambda self: self._concat('i2c'     ))
+    bgo     =Section(lambda self: self._concat('bgo'     ))
+    noise   =Section(lambda self: self._concat('noise'   ))
+    calib   =Section(lambda self: self._concat('calib'   ))
+    icalib  =Section(lambda self: self._concat('icalib'  ))
+    clk     =Section(lambda self: self._concat('clk'     ))
+    ilock   =Section(lambda self: self._concat('ilock'   ))
+    lvctrl  =Section(lambda self: self._concat('lvctrl'  ))
+    error   =Section(lambda self: self._concat('error'   ))
+
+    def __init__(self,reports):
+        ReportCollection.__init__(self,reports)
+        self.failures={}
+
+    def count_errors(self,freq='1h'):
+        # Fleet-wide error counts per AMAC, code and time bucket
+        return pd.concat([r.count_errors(freq) for r in self.reports], ignore_index=True)
+
+    @classmethod
+    def from_directory(cls,logdir='log',jobs=1,match='*',family=None,sections=None):
+        # Load all AMACs in logdir whose name matches the match pattern (and
+        # that have a log of the given family) from a single directory scan.
+        index=index_logs(scan_logs(logdir))
+        return cls.from_index(index,match_names(index,match,family),logdir,jobs,sections)
+
+    @classmethod
+    def from_index(cls,index,names,logdir='log',jobs=1,sections=None):
+        # Load the named AMACs from an index_logs() index, jobs at a time. Only
+        # the listed sections are parsed up front, all of them if None, or
+        # per chip if sections is a {name: sections} dict. Chips that fail to
+        # load are listed in failures.
+        if sections==None: sections=Report.SECTIONS
+        tasks=[(name,logdir,index[name],sections[name] if isinstance(sections,dict) else sections) for name in names]
+        if jobs>1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results=list(executor.map(_load_report,tasks))
+        else:
+            results=[_load_report(task) for task in tasks]
+
+        reports=[]
+        failures={}
+        for name,(r,error) in zip(names,results):
+            if r is None:
+                print('WARNING: Failed to load %s: %s'%(name,error))
+                failures[name]=error
+                continue
+            reports.append(r)
+
+        reports=cls(reports)
+        reports.failures=failures
+        return reports
+
+    @classmethod
+    def from_backend(cls,backend,names=None):
+        if names==None: names=backend.names('GeneralParams')
+        return cls([Report(name,backend=backend) for name in names])
+
+
+def _load_report(task):
+    name,logdir,logs,sections=task
+    try:
+        return Report(name,logdir,logs=logs,sections=sections),None
+    except Exception as e:
+        return None,''.join(traceback.format_exception_only(type(e),e)).strip()
 
 class Report:
-    def __init__(self,name):
+    SECTIONS=['genparam','i2c','bgo','noise','calib','icalib','clk','ilock','lvctrl','error']
+
+    # Test sections, parsed when first accessed
+    genparam=Section(lambda self: self.load_genparam())
+    i2c     =Section(lambda self: self.load_i2c     ())
+    bgo     =Section(lambda self: self.load_bgo     ())
+    noise   =Section(lambda self: self.load_noise   ())
+    calib   =Section(lambda self: self.load_calib   ())
+    icalib  =Section(lambda self: self.load_icalib  ())
+    clk     =Section(lambda self: self.load_clk     ())
+    ilock   =Section(lambda self: self.load_ilock   ())
+    lvctrl  =Section(lambda self: self.load_lvctrl  ())
+    error   =Section(lambda self: self.load_error   ())
+
+    def __init__(self,name,logdir='log',backend=None,logs=None,sections=()):
         self.name=name
-        self.genparam=None
-        self.i2c=None
-        self.bgo=None
-        self.noise=None
-        self.calib=None
-        self.icalib=None
-        self.clk=None
-        self.error=None
-
-        self.load_genparam()
-        self.load_i2c()
-        self.load_bgo()
-        self.load_noise()
-        self.load_calib()
-        self.load_icalib()
-        self.load_clk()
-        self.load_error()
+        self.logdir=logdir
+        self.backend=backend
+        self.logs=logs
+
+        self.preload(sections)
+
+    def preload(self,sections=None):
+        # Parse the listed sections now, all of them if None
+        if sections==None: sections=self.SECTIONS
+        for section in sections:
+            getattr(self,section)
+
+    @property
+    def bestBGO(self):
+        # BGO setting with the 1.2 V output closest to nominal
+        if '1V2' not in self.bgo: return None
+        minidx=abs(self.bgo['1V2']-1.2).idxmin()
+        return self.bgo.loc[minidx].BGreg_val
+
+    def _logs(self,family):
+        # List of (name, channel, path) for all logs of a family
+        if self.logs!=None:
+            return self.logs.get(family,[])
+
+        pattern=os.path.join(self.logdir,FAMILIES[family][0].format(AMAC=self.name))
+        re_logname=re.compile(re.escape(pattern).replace(re.escape('*'),'(.*)')+'$')
+        logs=[]
+        for path in sorted(glob.glob(pattern)):
+            match=re_logname.match(path)
+            logs.append((self.name,match.group(1) if re_logname.groups>0 else None,path))
+        return logs
+
+    def _read(self,family):
+        # Table of all logs of a family for this AMAC, None if there are none
+        if self.backend is not None:
+            return self.backend.read(family,AMAC=self.name)
+        return read_logs(family,self._logs(family))
 
     def load_genparam(self):
-        datapath='log/{AMAC}_GeneralParams.log'.format(AMAC=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['AMAC']=self.name
-            data['VCC_H']=data.apply(lambda row: float(row['Param'].split('_')[2]),axis=1)
-            data['Param']=data.apply(lambda row: '_'.join(row['Param'].split('_')[3:]),axis=1)
+        data=self._read('GeneralParams')
+        if data is not None:
+            param=data.Param.str.split('_',n=3)
+            data['VCC_H']=param.str[2].astype(float)
+            data['Param']=param.str[3].fillna('').astype('category')
+        else:
+            data=empty(SCHEMAS['GeneralParams'])
         self.genparam=data
 
     def load_i2c(self):
-        datapath='log/{AMAC}_I2C_main.log'.format(AMAC=self.name)
-        data=pd.DataFrame()
-        if os.path.exists(datapath):
-            data=pd.read_csv(datapath,sep=' ')
-            data['AMAC']=self.name
+        data=self._read('I2C')
+        if data is None:
+            data=empty(SCHEMAS['I2C'])
         self.i2c=data
 
     def load_bgo(self):
-        re_logname=re.compile('log/{AMAC}_BG_(.*).log'.format(AMAC=self.name))
-
         data=pd.DataFrame(columns=['AMAC','BGreg_val'])
         data=data.set_index(['AMAC','BGreg_val'])
-        for log in glob.glob('log/{AMAC}_BG_*.log'.format(AMAC=self.name)):
-            a=pd.read_csv(log,sep=' ')
-            match=re_logname.match(log)
-            a['AMAC']=self.name
-            a=a.set_index(['AMAC','BGreg_val'])
-            a=a.rename(columns={'Voltage':match.group(1),'mean':match.group(1),'stddev':'%s_stddev'%match.group(1)})
-            data=pd.concat([data,a],axis=1)
+        logs=self._read('BG')
+        if logs is not None:
+            for chkey,a in logs.groupby('Channel',sort=False):
+                a=a.drop(columns='Channel').dropna(axis=1,how='all')
+                a=a.set_index(['AMAC','BGreg_val'])
+                a=a.rename(columns={'Voltage':chkey,'mean':chkey,'stddev':'%s_stddev'%chkey})
+                data=pd.concat([data,a],axis=1)
 
         self.bgo=data.reset_index()
 
-        # figure out
-        if '1V2' in self.bgo:
-            minidx=abs(self.bgo['1V2']-1.2).idxmin()
-            self.bestBGO=self.bgo.loc[minidx].BGreg_val
-
     def load_noise(self):
-        re_logname=re.compile('log/{AMAC}_noise_ADC_V_(.*).log'.format(AMAC=self.name))
-
-        data=pd.DataFrame(columns=['AMAC','Channel','InputVoltage','BandgapControl','RampGain','ADCvalue'])
-        for log in glob.glob('log/{AMAC}_noise_ADC_V_*.log'.format(AMAC=self.name)):
-            a=pd.read_csv(log,sep=' ')
-            match=re_logname.match(log)
-            a['AMAC']=self.name
-            a['Channel']=match.group(1)
-            data=data.append(a)
-
+        data=self._read('noise')
+        if data is None:
+            data=empty(SCHEMAS['noise'])
         self.noise=data
 
     def load_calib(self):
-        re_logname=re.compile('log/{AMAC}_calib_ADC_V_(.*).log'.format(AMAC=self.name))
-
-        data=pd.DataFrame(columns=['AMAC','Channel','InputVoltage','BandgapControl','RampGain','ADCvalue'])
-        for log in glob.glob('log/{AMAC}_calib_ADC_V_*.log'.format(AMAC=self.name)):
-            a=pd.read_csv(log,sep=' ')
-            match=re_logname.match(log)
-            a['AMAC']=self.name
-            a['Channel']=match.group(1)
-            data=data.append(a)
-
+        data=self._read('calib_ADC_V')
+        if data is None:
+            data=empty(SCHEMAS['calib_ADC_V'])
         self.calib=data
 
     def load_icalib(self):
-        re_logname=re.compile('log/{AMAC}_calib_ADC_I_(.*).log'.format(AMAC=self.name))
-
-        resvalues=[0,100,10e3,1e6]
-
-        data=pd.DataFrame(columns=['AMAC','Channel','InputCurrent','BandgapControl','RampGain','OpAmpGain','ResistorIdx','ADCvalue'])
-        for log in glob.glob('log/{AMAC}_calib_ADC_I_*.log'.format(AMAC=self.name)):
-            a=pd.read_csv(log,sep=' ')
-            match=re_logname.match(log)
-            a['AMAC']=self.name
-            a['Channel']=match.group(1)
-            a['ResistorValue']=a.ResistorIdx.map(lambda x: resvalues[x])
-            data=data.append(a)
-
+        data=self._read('calib_ADC_I')
+        if data is not None:
+            data['ResistorValue']=RESISTORS[data.ResistorIdx.values]
+        else:
+            data=empty(dict(SCHEMAS['calib_ADC_I'],ResistorValue='float64'))
         self.icalib=data
 
     def load_clk(self):
-        datapath='log/{AMAC}_CLK_main.log'.format(AMAC=self.name)
-        row=[self.name,0,0,0,0,0,0,0,0,0,0]
-        if os.path.exists(datapath):
-            fh=open(datapath)
-            data={}
-            for line in fh:
-                line=line.strip()
-                if line=='': continue
-                parts=line.split()
-                data[parts[0]]=(int(parts[1]),int(parts[2]))
-            fh.close()
-
-            row=[self.name,
-                 data['Internal_Oscillator:'][0],data['Internal_Oscillator:'][1],
-                 data['External_Oscillator_10M_HVenabled_div0_HVCTRL:'][0],data['External_Oscillator_10M_HVenabled_div0_HVCTRL:'][1],
-                 data['External_Oscillator_10M_HVenabled_div1_HVCTRL:'][0],data['External_Oscillator_10M_HVenabled_div1_HVCTRL:'][1],
-                 data['External_Oscillator_10M_HVenabled_div2_HVCTRL:'][0],data['External_Oscillator_10M_HVenabled_div2_HVCTRL:'][1],
-                 data['External_Oscillator_10M_HVenabled_div3_HVCTRL:'][0],data['External_Oscillator_10M_HVenabled_div3_HVCTRL:'][1]
-                 ]
-
-        self.clk=pd.DataFrame([row], columns=['AMAC','Internal_Freq','Internal_DC',
-                                              'External_Div0_Freq','External_Div0_DC',
-                                              'External_Div1_Freq','External_Div1_DC',
-                                              'External_Div2_Freq','External_Div2_DC',
-                                              'External_Div3_Freq','External_Div3_DC'])
+        # Frequency and duty cycle of the clock measurements, 0 if missing
+        clk=self._read('CLK')
+        values={} if clk is None else dict(zip(zip(clk.Key,clk.Index),clk.Value))
+
+        row={'AMAC':self.name}
+        for column,key in CLKCOLUMNS.items():
+            row['%s_Freq'%column]=values.get((key,0),0)
+            row['%s_DC'  %column]=values.get((key,1),0)
+        self.clk=pd.DataFrame([row])
+
+    def load_ilock(self):
+        # Interlock tests with (DAC=True) and without the threshold DAC
+        frames=[]
+        for family,dac in [('ILOCK_DAC',True),('ILOCK_noDAC',False)]:
+            data=self._read(family)
+            if data is not None:
+                data['DAC']=dac
+                frames.append(data)
+        self.ilock=concat(frames) if len(frames)>0 else empty(dict(SCHEMAS['ILOCK_DAC'],DAC='bool'))
+
+    def load_lvctrl(self):
+        data=self._read('LVCTRL')
+        self.lvctrl=data if data is not None else empty(SCHEMAS['LVCTRL'])
 
     def load_error(self):
-        datapath='log/{AMAC}_Errors.log'.format(AMAC=self.name)
-        if os.path.exists(datapath):
-            a=pd.read_csv(datapath, header=None, names=['raw']) #,sep=' ')
-            a['AMAC']=self.name
-            a['code']=a.apply(lambda row: int(row['raw'].split()[-1]),axis=1)
-            a['date']=a.apply(lambda row: datetime.datetime.strptime(' '.join(row['raw'].split()[:5]),'%a %b %d %H:%M:%S %Y'),axis=1)
-            self.error=a
+        a=self._read('Errors')
+        if a is None:
+            a=empty(SCHEMAS['Errors'])
+        self.error=a
+
+    def count_errors(self,freq='1h'):
+        # Error counts per code and time bucket. Streams through the logs
+        # unless the error section is already loaded or comes from a backend.
+        if 'error' not in self.__dict__ and self.backend is None:
+            counts=[count_errors(path,freq).set_index(['date','code'])['count'] for name,channel,path in self._logs('Errors')]
         else:
-            self.error=pd.DataFrame()
+            errors=self.error
+            counts=[errors.groupby([errors.date.dt.floor(freq),'code']).size()] if len(errors)>0 else []
+        counts=_sum_counts(counts)
+        counts['AMAC']=self.name
+        return counts
 
     def _render_genparam_row_html(self,title,param,genparam):
         genparam=genparam[genparam.Param==param]
@@ -182,7 +506,7 @@ class Report:
                 color='red'
             elif error.iloc[0]>0.01:
                 color='orange'
-            info+='<td style="color: %s">%f (%f)</td>'%(color,viogroup.val,viogroup.stddev)
+            info+='<td style="color: %s">%f (%f)</td>'%(color,viogroup.val.iloc[0],viogroup.stddev.iloc[0])
         return '<tr><td>%s</td>%s</tr>'%(title,info)
 
     def render_genparam(self):
@@ -221,10 +545,11 @@ class Report:
         plt.legend(frameon=False)
 
     def render_noise(self):
-        data=self.noise[(self.noise.AMAC==self.name)]
-        for chkey,chgroup in data.groupby('Channel'):
-            print(chkey,chgroup.ADCvalue.mean(),chgroup.ADCvalue.std())
-            plt.hist(chgroup.ADCvalue,range=(512-64,512+64),bins=123,label=chkey)
+        hists=noisetools.NoiseHistograms.from_data(self.noise[(self.noise.AMAC==self.name)]).sum(['Channel'])
+        stats=hists.stats()
+        for idx,row in stats.iterrows():
+            print(row.Channel,row['mean'],row['std'])
+            plt.stairs(hists.counts[idx,512-64:512+64],np.arange(512-64,512+64+1),label=row.Channel)
         plt.legend(frameon=False)
         plt.xlabel('ADC Count')
         plt.show()
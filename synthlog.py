@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import pandas as pd
+import numpy as np
+
+import argparse
+import os, os.path
+
+#
+# Synthetic log/ and pblog/ trees in the same format as the test stand
+# output, for benchmarking at any number of chips. Each chip gets its own ADC
+# transfer curves with gain and offset spread, a small integral
+# non-linearity, saturation at the ends of the range and a fraction of
+# outlier readings. The same seed always gives the same tree.
+
+CHANNELS=['CH0_L','CH0_R','CH1_R','CH2_R','CH3_L_Gain1','CH3_L_Gain23','CH3_R_Gain1','CH3_R_Gain23']
+
+GENERALPARAMS=['BG','DVDD_2','OTA_L','OTA_R','Temp','VDD_2_L','VDD_2_R','VDD_H_4','VDD_Reset','VDD_Run','current_1V5_Reset','current_1V5_Run']
+BGCHANNELS=['1V2','BGO','NTCPWR','OTA','VDD_Run','current_1V5_Run']
+ERRORCODES=[3003,1003,1,9000,6047]
+
+CLKKEYS=['ClkOut_disabled','Internal_Oscillator','External_Oscillator_10k','External_Oscillator_1M','External_Oscillator_50M']+\
+        ['External_Oscillator_10M_HV%s_div%d_HVCTRL%s'%(hv,div,b) for hv in ['enabled','disabled'] for div in range(4) for b in ['','B']]
+
+# Nominal ADC slope in counts/V for each RampGain, and offset in counts
+SLOPES={0:560.,1:1600.,2:1100.,3:820.}
+OFFSET=9.
+
+def chipnames(nchips):
+    # AMAC_A01, AMAC_B01, ..., AMAC_Z01, AMAC_A02, ...
+    return ['AMAC_%s%02d'%(chr(ord('A')+i%26),i//26+1) for i in range(nchips)]
+
+class Chip:
+    # Random properties of one synthetic AMAC
+    def __init__(self,name,rng,outliers=1e-3):
+        self.name=name
+        self.rng=rng
+        self.outliers=outliers
+
+        self.gain  =rng.normal(1,0.03,len(CHANNELS))
+        self.offset=rng.normal(OFFSET,2,len(CHANNELS))
+        self.inl   =rng.normal(0,0.5,len(CHANNELS))
+        self.noise =np.abs(rng.normal(0.3,0.1,len(CHANNELS)))
+        if rng.uniform()<0.05: self.noise*=10
+
+        self.m   =rng.normal(3e-8,1e-9)
+        self.Voff=rng.normal(-0.1,0.01)
+        self.RI  =rng.normal(50,5)
+
+    def adc(self,ch,V,BG,RG,outliers=True):
+        # Voltage ADC codes of channel index ch
+        slope=np.vectorize(SLOPES.get)(RG)*self.gain[ch]*(1+0.01*(BG-10))
+        ideal=self.offset[ch]+V*slope
+        ideal+=self.inl[ch]*np.sin(np.pi*ideal/1024)
+        code=np.round(ideal+self.rng.normal(0,self.noise[ch],len(ideal)))
+
+        bad=self.rng.uniform(size=len(code))<(self.outliers if outliers else 0)
+        code[bad]=self.rng.integers(0,1024,bad.sum())
+        return np.clip(code,0,1023).astype(int)
+
+    def iadc(self,I,R,BG,RG,OA):
+        # Current ADC codes, inverse of icalibtools.currentcalib
+        Rload=R+60
+        Icorr=(I*Rload-self.Voff)/(Rload+self.RI)
+        m=self.m/(1+OA)*(1+0.01*(BG-10))*SLOPES[3]/np.vectorize(SLOPES.get)(RG)
+        code=np.round(Icorr/m+OFFSET+self.rng.normal(0,0.5,len(I)))
+        return np.clip(code,0,1023).astype(int)
+
+def write(path,header,columns,fmt,sep=' '):
+    with open(path,'w') as fh:
+        fh.write(sep.join(header)+'\n')
+        lines=[sep.join(fmt)%row for row in zip(*columns)]
+        fh.write('\n'.join(lines)+'\n')
+
+def write_amac(chip,logdir,errors=1000):
+    rng=chip.rng
+    path=lambda family: os.path.join(logdir,'%s_%s.log'%(chip.name,family))
+
+    # General parameters at a few VCC_H values
+    vcc=np.repeat([1.5,2.0,2.5,3.0],len(GENERALPARAMS))
+    params=['VCC_H_%f_%s'%(v,p) for v,p in zip(vcc,GENERALPARAMS*4)]
+    write(path('GeneralParams'),['Param','val','stddev'],
+          [params,rng.uniform(0,1.5,len(params)),np.abs(rng.normal(0,1e-4,len(params)))],['%s','%g','%g'])
+
+    # I2C success rate against VCC_H
+    vcc=0.65+0.05*np.arange(47)+rng.normal(0,2e-4,47)
+    write(path('I2C_main'),['VCC_H','I2C_SuccessRate'],[vcc,(vcc>rng.uniform(0.7,0.9)).astype(int)],['%g','%d'])
+
+    # Bandgap scans
+    bg=np.arange(17)
+    for bgch in BGCHANNELS:
+        write(path('BG_%s'%bgch),['BGreg_val','Voltage','stddev'],
+              [bg,rng.uniform(0.4,1.3)+0.008*bg+rng.normal(0,0.003,len(bg)),np.abs(rng.normal(0.02,0.01,len(bg)))],['%d','%g','%g'])
+
+    # Clock measurements
+    with open(path('CLK_main'),'w') as fh:
+        for key in CLKKEYS:
+            on=key!='ClkOut_disabled' and ('_HV' not in key or ('HVenabled' in key)!=key.endswith('B'))
+            fh.write('%s: %d %d\n'%(key,int(rng.normal(1e7,1e6)) if on else 0,rng.integers(10,60) if on else 0))
+
+    # Voltage ADC calibration and noise
+    V=np.tile(np.round(np.linspace(0,1.19,120)+rng.normal(0,1e-4,120),6),64)
+    BG=np.repeat(np.arange(16),4*120)
+    RG=np.tile(np.repeat(np.arange(4),120),16)
+    for ch,chname in enumerate(CHANNELS):
+        write(path('calib_ADC_V_%s'%chname),['InputVoltage','BandgapControl','RampGain','ADCvalue'],
+              [V,BG,RG,chip.adc(ch,V,BG,RG)],['%g','%d','%d','%d'])
+
+        Vn=np.full(1000,round(rng.uniform(0.59,0.9),6))
+        write(path('noise_ADC_V_%s'%chname),['InputVoltage','BandgapControl','RampGain','ADCvalue'],
+              [Vn,np.full(1000,10),np.full(1000,3),chip.adc(ch,Vn,10,np.full(1000,3),False)],['%g','%d','%d','%d'])
+
+    # Current ADC calibration, one sweep per BG, RG and OpAmpGain
+    I =np.tile(np.linspace(0,3.3e-6,101),256)*rng.normal(1,1e-3,101*256)
+    BG=np.repeat([0,5,10,15],4*16*101)
+    RG=np.tile(np.repeat(np.arange(4),16*101),4)
+    OA=np.tile(np.repeat(np.arange(16),101),16)
+    write(path('calib_ADC_I_RIGHT'),['InputCurrent','BandgapControl','RampGain','OpAmpGain','ResistorIdx','ADCvalue'],
+          [I,BG,RG,OA,np.full(len(I),3),chip.iadc(I,1e6,BG,RG,OA)],['%g','%d','%d','%d','%d','%d'])
+
+    # Error log, in ctime format
+    dates=pd.Timestamp('2017-10-03 11:51:13')+pd.to_timedelta(np.cumsum(rng.exponential(60,errors)).astype(int),unit='s')
+    codes=rng.choice(ERRORCODES,errors,p=[0.6,0.2,0.1,0.05,0.05])
+    with open(path('Errors'),'w') as fh:
+        fh.write(''.join(['%s [%s] SW Error %d\n'%(date,chip.name,code) for date,code in zip(dates.strftime('%a %b %e %H:%M:%S %Y'),codes)]))
+
+def write_pb(chip,pblogdir):
+    rng=chip.rng
+    path=lambda family: os.path.join(pblogdir,'PB_%s_%s.log'%(chip.name,family))
+
+    write(path('General'),['OTALEFT','OTARIGHT','DVDD2','BGO','InBase'],
+          [[rng.integers(680,710)],[rng.integers(680,710)],[rng.integers(600,630)],[rng.integers(500,530)],[rng.normal(0.4,0.01)]],
+          ['%d','%d','%d','%d','%+.8E'])
+
+    # Input voltage through the 90.9k/10k divider on CH0_R
+    Vin=np.round(np.arange(6,12.05,0.1),1)
+    write(path('VIN'),['Vin','VinADC'],[Vin,chip.adc(1,Vin*10/100.9,np.full(len(Vin),10),np.full(len(Vin),3))],['%g','%d'])
+
+    Vin=np.round(np.arange(4,5.01,0.05),2)
+    write(path('VinIin'),['Vin','Iin','Vout'],[Vin,rng.normal(0.36,0.01,len(Vin)),np.zeros(len(Vin))],['%g','%+.8E','%d'],sep='\t')
+
+    # DC-DC efficiency, output current sensed on CH1_R
+    Iout=np.arange(0,4001,100)
+    Iin=0.42+Iout/1000*1.5/11/0.7
+    write(path('DCDCEfficiency'),['Iout','Vout','Iin','Vin','IoutADC','ntc','ptat'],
+          [Iout,np.full(len(Iout),1530),Iin,np.full(len(Iout),11.),chip.adc(2,Iout/1000*0.008*25,np.full(len(Iout),10),np.full(len(Iout),3)),
+           rng.integers(210,330,len(Iout)),rng.integers(380,980,len(Iout))],['%d','%d','%+.8E','%+.8E','%d','%d','%d'])
+
+    Ileak=np.concatenate([np.arange(1,11)*1e-6,np.arange(1,11)*1e-5,np.arange(1,9)*1e-4+1e-5])
+    gains=[np.clip(np.round(40+Ileak*g*1e6),0,1023).astype(int) for g in [1,2,4,8,16]]
+    write(path('Ileak'),['HV','Ileak','OpAmpGain0','OpAmpGain1','OpAmpGain2','OpAmpGain4','OpAmpGain8'],
+          [Ileak*5e5,Ileak]+gains,['%+.6E','%g','%d','%d','%d','%d','%d'])
+
+    # Coil pickup, with the DC-DC switching noise when LV is on
+    t=np.arange(8192)*6.4e-9
+    for family,ampl in [('CoilLVON',3.),('CoilLVOFF',0.3)]:
+        coil=ampl*np.sin(2*np.pi*rng.normal(1.9e6,5e4)*t)+rng.normal(0,1,len(t))
+        write(path(family),['time','coil'],[t,np.round(coil/1.5748)*1.5748],['%g','%g'])
+
+def generate(root,nchips=80,seed=0,errors=1000,outliers=1e-3,pb=True):
+    # Write root/log and root/pblog for nchips chips, returning their names
+    logdir  =os.path.join(root,'log')
+    pblogdir=os.path.join(root,'pblog')
+    os.makedirs(logdir,exist_ok=True)
+    os.makedirs(pblogdir,exist_ok=True)
+
+    names=chipnames(nchips)
+    for i,name in enumerate(names):
+        chip=Chip(name,np.random.default_rng([seed,i]),outliers)
+        write_amac(chip,logdir,errors)
+        if pb: write_pb(chip,pblogdir)
+    return names
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Generate synthetic AMAC and power board test logs.')
+    parser.add_argument('output'                                ,help='Output directory, gets log/ and pblog/')
+    parser.add_argument('--chips'   ,type=int  ,default=80      ,help='Number of chips')
+    parser.add_argument('--seed'    ,type=int  ,default=0       ,help='Random seed')
+    parser.add_argument('--errors'  ,type=int  ,default=1000    ,help='Error log lines per chip')
+    parser.add_argument('--outliers',type=float,default=1e-3    ,help='Fraction of outlier ADC readings')
+    parser.add_argument('--no-pb'   ,action='store_true'        ,help='Do not write power board logs')
+    args=parser.parse_args()
+
+    names=generate(args.output,args.chips,args.seed,args.errors,args.outliers,not args.no_pb)
+    print('Wrote %d chips to %s'%(len(names),args.output))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+
+import argparse
+import fnmatch
+import io
+import os, os.path
+import time
+
+import report
+import calibcache
+import calibstore
+
+import calibtools
+import icalibtools
+
+#
+# Online ADC calibration of the chips under test. The calib_ADC_V/I logs are
+# followed as the test stand appends to them, and each (BandgapControl,
+# RampGain[, OpAmpGain]) sweep is fitted as soon as it is complete, with the
+# same fits as generate_config.py. The test stand writes one sweep after the
+# other, so a sweep is complete when the next one starts, or when its log has
+# not grown for a while (the last sweep of a file). The rows of the completed
+# sweeps are kept, so that a sweep repeated later in a log is fitted on the
+# points of all of its runs, like the batch fit does. Memory is thus bounded
+# by the calibration logs of the chips under test.
+#
+# A calibration is only stored in the cache once every row of its logs has
+# been fitted, so that the cache manifest never vouches for a calibration
+# that misses the open sweeps. Until then, it is written to the partial/
+# directory of the cache, which CalibCache and calibstore do not read.
+
+# Sweep keys of each calibration, in the order of the log columns
+SWEEPKEYS={'calib' :['BandgapControl','RampGain'],
+           'icalib':['BandgapControl','RampGain','OpAmpGain']}
+
+# Calibration of each log family
+KINDS={family:kind for kind,family in calibcache.INPUTS.items()}
+
+def fit_calib(data):
+    return calibtools.calibrate(data)
+
+def fit_icalib(data):
+    data['ResistorValue']=report.RESISTORS[data.ResistorIdx.values]
+    return icalibtools.calibrate(data,fixCalib=True)
+
+FITS={'calib' :fit_calib,
+      'icalib':fit_icalib}
+
+class LogFollower:
+    # Rows appended to a space separated log since the last poll. A partial
+    # last line is kept until the rest of it is written.
+    def __init__(self,path,dtype=None):
+        self.path=path
+        self.dtype=dtype
+        self.reset()
+
+    def reset(self):
+        self.offset=0
+        self.columns=None
+        self.partial=b''
+
+    def poll(self):
+        # New complete rows, None if there are none. A file that shrank was
+        # rewritten and is read again from the start.
+        size=os.path.getsize(self.path)
+        if size<self.offset:
+            self.reset()
+        if size==self.offset:
+            return None
+
+        with open(self.path,'rb') as fh:
+            fh.seek(self.offset)
+            chunk=fh.read(size-self.offset)
+        self.offset+=len(chunk)
+
+        chunk=self.partial+chunk
+        end=chunk.rfind(b'\n')+1
+        chunk,self.partial=chunk[:end],chunk[end:]
+        if self.columns==None:
+            header,sep,chunk=chunk.partition(b'\n')
+            if not sep:
+                self.partial=header
+                return None
+            self.columns=header.decode().split()
+        if len(chunk)==0:
+            return None
+
+        dtype={column:self.dtype[column] for column in self.columns if column in self.dtype} if self.dtype else None
+        return report.typed(pd.read_csv(io.BytesIO(chunk),sep=' ',header=None,names=self.columns,dtype=report.parsetypes(dtype)),dtype)
+
+class SweepFollower(LogFollower):
+    # Complete sweeps of one calibration log of a chip
+    def __init__(self,kind,AMAC,Channel,path):
+        LogFollower.__init__(self,path,report.SCHEMAS[calibcache.INPUTS[kind]])
+        self.kind=kind
+        self.AMAC=AMAC
+        self.Channel=Channel
+        self.keys=SWEEPKEYS[kind]
+        self.sweep=[]
+        self.lastchange=time.monotonic()
+
+    def reset(self):
+        LogFollower.reset(self)
+        self.sweep=[]
+        self.done={}
+
+    def _close(self):
+        # Complete the open sweep, returning its keys
+        data=pd.concat(self.sweep,ignore_index=True)
+        self.sweep=[]
+        key=tuple(data[self.keys].iloc[0])
+        self.done.setdefault(key,[]).append(data)
+        return key
+
+    def _sweeps(self,keys):
+        # Data of all completed runs of each sweep
+        sweeps=[]
+        for key in dict.fromkeys(keys):
+            data=pd.concat(self.done[key],ignore_index=True)
+            data.insert(0,'AMAC'   ,self.AMAC   )
+            data.insert(1,'Channel',self.Channel)
+            sweeps.append(data)
+        return sweeps
+
+    def poll(self,idle=None,flush=False):
+        # List of the sweeps completed since the last poll, with the points
+        # of their earlier runs if they were repeated. The open sweep is also
+        # completed if the log did not grow for idle seconds, or if flush (ie:
+        # at the end of a run).
+        data=LogFollower.poll(self)
+        now=time.monotonic()
+
+        keys=[]
+        if data is not None and len(data)>0:
+            self.lastchange=now
+
+            # Split the rows where the sweep keys change
+            values=data[self.keys].values
+            starts=np.flatnonzero((values[1:]!=values[:-1]).any(axis=1))+1
+            if len(self.sweep)>0 and (self.sweep[-1][self.keys].values[-1]!=values[0]).any():
+                keys.append(self._close())
+            for i,(start,end) in enumerate(zip(np.r_[0,starts],np.r_[starts,len(data)])):
+                if i>0:
+                    keys.append(self._close())
+                self.sweep.append(data.iloc[start:end])
+        elif idle!=None and len(self.sweep)>0 and now-self.lastchange>=idle:
+            keys.append(self._close())
+        if flush and len(self.sweep)>0:
+            keys.append(self._close())
+        return self._sweeps(keys)
+
+class Watcher:
+    # Follows the calibration logs of the matching chips in logdir, and keeps
+    # the calibrations of the completed sweeps of each (AMAC, kind).
+    def __init__(self,logdir='log',match=['AMAC_???'],kinds=list(FITS),cache=None,idle=30,verbose=True):
+        self.logdir=logdir
+        self.match=match
+        self.kinds=kinds
+        self.cache=cache
+        self.idle=idle
+        self.verbose=verbose
+        self.followers={}
+        self.calibs={}
+
+    def scan(self):
+        # Start following any new calibration log
+        families={calibcache.INPUTS[kind]:report.FAMILIES[calibcache.INPUTS[kind]] for kind in self.kinds}
+        for family,logs in report.scan_logs(self.logdir,families).items():
+            for name,channel,path in logs:
+                if path in self.followers or not any(fnmatch.fnmatch(name,pattern) for pattern in self.match): continue
+                self.followers[path]=SweepFollower(KINDS[family],name,channel,path)
+
+    def fit(self,follower,sweeps):
+        calib=FITS[follower.kind](pd.concat(sweeps,ignore_index=True))
+        keys=SWEEPKEYS[follower.kind]
+        for idx,row in calib.iterrows():
+            status=row.get('status','ok')
+            if self.verbose:
+                print('%s %-6s %-16s %s: m=%0.5g b=%0.5g%s'%(follower.AMAC,follower.kind,follower.Channel,
+                                                              ' '.join(['%s=%d'%(key,row[key]) for key in keys]),
+                                                              row.m,row.b,'' if status=='ok' else ' BAD (%s)'%status))
+        if 'status' in calib.columns:
+            calib=calib[calib.status=='ok'].drop(columns='status')
+        return calib
+
+    def update(self,follower,sweeps):
+        # Add the calibrations of the completed sweeps of a log, replacing
+        # those of earlier runs of the same sweeps
+        calib=self.fit(follower,sweeps)
+        key=(follower.AMAC,follower.kind)
+        if key not in self.calibs and len(calib)==0: return None
+
+        # Earlier calibrations of the sweeps are dropped, even if their refit
+        # failed, as in a batch fit of all of their points
+        calibkeys=icalibtools.CALIBKEYS if follower.kind=='icalib' else calibtools.CALIBKEYS
+        old=self.calibs.get(key)
+        if old is not None:
+            refit=set([(follower.Channel,)+tuple(sweep[follower.keys].iloc[0]) for sweep in sweeps])
+            old=old[[k not in refit for k in zip(old.Channel,*[old[column] for column in follower.keys])]]
+        calib=pd.concat([old,calib],ignore_index=True)
+        self.calibs[key]=calib.sort_values(calibkeys,ignore_index=True)
+        return key
+
+    def partialpath(self,AMAC,kind):
+        return os.path.join(self.cache.cachedir,'partial','%s_%s.csv'%(kind,AMAC))
+
+    def complete(self,AMAC,kind,inputs):
+        # Whether every row of the logs of (AMAC, kind), as described by their
+        # fingerprint, has been read and fitted
+        followers={os.path.basename(path):follower for path,follower in self.followers.items() if (follower.AMAC,follower.kind)==(AMAC,kind)}
+        for entry in inputs:
+            follower=followers.get(entry['path'])
+            if follower==None or follower.offset!=entry['size'] or len(follower.partial)>0 or len(follower.sweep)>0:
+                return False
+        return True
+
+    def store(self,AMAC,kind):
+        # Store a complete calibration in the cache, and any other one in the
+        # partial directory. Returns whether it was complete.
+        calib=self.calibs[(AMAC,kind)]
+        partialpath=self.partialpath(AMAC,kind)
+        inputs=calibcache.fingerprint(self.cache.inputs(AMAC,kind))
+        if self.complete(AMAC,kind,inputs):
+            self.cache.store(AMAC,calib,kind,inputs)
+            if os.path.exists(partialpath): os.remove(partialpath)
+            return True
+
+        os.makedirs(os.path.dirname(partialpath),exist_ok=True)
+        calib.to_csv(partialpath+'.tmp',index=False)
+        os.replace(partialpath+'.tmp',partialpath)
+        return False
+
+    def poll(self,flush=False):
+        # Fit all sweeps completed since the last poll, and store the updated
+        # calibrations. If flush, the open sweeps are completed too. Returns
+        # the updated (AMAC, kind).
+        self.scan()
+        updated=set()
+        for follower in self.followers.values():
+            sweeps=follower.poll(self.idle,flush)
+            if len(sweeps)>0:
+                updated.add(self.update(follower,sweeps))
+        updated.discard(None)
+
+        if self.cache!=None:
+            stored=set([kind for AMAC,kind in sorted(updated) if self.store(AMAC,kind)])
+            for kind in sorted(stored):
+                calibstore.build(self.cache.cachedir,kind)
+        return updated
+
+    def run(self,interval=1,once=False):
+        # Poll until interrupted, or only once, completing all sweeps. When
+        # interrupted, the open sweeps are completed as they are, ie: the
+        # calibrations match a batch fit of the logs at that point.
+        if once:
+            return self.poll(flush=True)
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            self.poll(flush=True)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Fit the ADC calibrations of the chips under test as their calibration logs are written.')
+    parser.add_argument('--calibrations',nargs='+',choices=list(FITS),default=list(FITS),help='Calibrations to run')
+    parser.add_argument('--chips'       ,nargs='+',default=['AMAC_???']        ,help='Chip name patterns')
+    parser.add_argument('--log'         ,default='log'                         ,help='AMAC test log directory')
+    parser.add_argument('--output'      ,default='data/calib'                  ,help='Calibration output directory')
+    parser.add_argument('--interval'    ,type=float,default=1                  ,help='Seconds between polls of the logs')
+    parser.add_argument('--idle'        ,type=float,default=30                 ,help='Seconds after which the last sweep of a log that stopped growing is complete')
+    parser.add_argument('--once'        ,action='store_true'                   ,help='Fit the logs as they are now and exit')
+    args=parser.parse_args()
+
+    watcher=Watcher(args.log,args.chips,args.calibrations,calibcache.CalibCache(args.output,args.log),idle=args.idle)
+    watcher.run(args.interval,args.once)